@@ -1,7 +1,13 @@
 import asyncio
 import logging
+import signal
 
 from modules.models import get_main_bot
+from modules.redis_connection import get_redis
+from modules.settings import get_settings
+from modules.sharding import run_supervisor
+
+bot_settings = get_settings()
 
 
 async def main():
@@ -9,11 +15,33 @@ async def main():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         level=logging.INFO,
     )
-    await get_main_bot().start_main_bot()
+    main_bot = get_main_bot()
+    # SIGTERM of a deploy drains queued replies before the bots disconnect
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main_bot.request_shutdown)
+    try:
+        await main_bot.start_main_bot()
+    finally:
+        await get_redis().aclose()
 
 
-if __name__ == "__main__":
+def run_shard():
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("Bot stopped by the user")
+
+
+if __name__ == "__main__":
+    if bot_settings.SHARD_COUNT > 1 and bot_settings.SHARD_ID is None:
+        logging.basicConfig(
+            format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+            level=logging.INFO,
+        )
+        try:
+            run_supervisor(bot_settings.SHARD_COUNT, run_shard)
+        except KeyboardInterrupt:
+            logging.info("Bot stopped by the user")
+    else:
+        run_shard()
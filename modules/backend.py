@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from typing import Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from .cache import get_response_cache, ResponseCache
+from .metrics import get_metrics, Metrics
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+# Define a global backend response cache
+response_cache: ResponseCache = get_response_cache()
+
+# Define global metrics
+metrics: Metrics = get_metrics()
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """The host failed too often recently, the request was not sent"""
+
+
+class CircuitBreaker:
+    """
+    Stops requests to a host after `threshold` consecutive failures. After
+    `reset_timeout` seconds one trial request is let through, it closes the
+    circuit on success and opens it again on failure
+    """
+
+    CLOSED: str = "closed"
+    OPEN: str = "open"
+    HALF_OPEN: str = "half_open"
+
+    def __init__(self, host: str, threshold: int, reset_timeout: float):
+        self.host: str = host
+        self.threshold: int = threshold
+        self.reset_timeout: float = reset_timeout
+        self.failures: int = 0
+        self.state: str = self.CLOSED
+        self.opened_at: float = 0
+
+    def __repr__(self):
+        return f"CircuitBreaker(host={self.host}, state={self.state}, failures={self.failures})"
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        # One trial request per reset timeout while open or half open
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.state = self.CLOSED
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                logger.warning(
+                    f"Circuit for {self.host} opened after {self.failures} failures"
+                )
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class BackendClient:
+    """
+    Process-wide HTTP client for the backend and the Bot API. Every bot shares one
+    session and one tuned connection pool, and requests to a host are capped by
+    BACKEND_HOST_CONCURRENCY. Requests time out after BACKEND_TIMEOUT, reads are
+    retried with jittered backoff and every host has its own circuit breaker
+    """
+
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+        self.breakers: dict[str, CircuitBreaker] = {}
+        # Single-flight GET requests by cache key, with their cache tags
+        self.pending_reads: dict[str, asyncio.Future] = {}
+        self.pending_tags: dict[str, list[str]] = {}
+        self.coalesced_reads: int = 0
+        # Writes per cache tag, a read that overlapped a write isn't cached
+        self.generations: Counter = Counter()
+        # Pool metrics per host
+        self.in_flight: Counter = Counter()
+        self.waiting: Counter = Counter()
+        self.saturated: Counter = Counter()  # requests that waited for a slot
+
+    async def init_session(self):
+        if not self.session:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=bot_settings.BACKEND_POOL_LIMIT,
+                    limit_per_host=bot_settings.BACKEND_HOST_CONCURRENCY,
+                    keepalive_timeout=bot_settings.BACKEND_KEEPALIVE_TIMEOUT,
+                    use_dns_cache=True,
+                    ttl_dns_cache=bot_settings.BACKEND_DNS_CACHE_TTL,
+                )
+            )
+
+    async def close_session(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    @asynccontextmanager
+    async def host_slot(self, url: str):
+        """Hold one of the concurrent request slots of the url's host"""
+        host = urlsplit(url).netloc
+        semaphore = self.semaphores.setdefault(
+            host, asyncio.Semaphore(bot_settings.BACKEND_HOST_CONCURRENCY)
+        )
+        if semaphore.locked():
+            self.saturated[host] += 1
+        self.waiting[host] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting[host] -= 1
+        self.in_flight[host] += 1
+        try:
+            yield
+        finally:
+            self.in_flight[host] -= 1
+            semaphore.release()
+
+    @staticmethod
+    def get_endpoint(url: str) -> str:
+        """Metrics label of a url, without the query, ids and bot tokens"""
+        parts = urlsplit(url)
+        if url.startswith(f"{bot_settings.TELEGRAM_API_URL}/bot"):
+            return f"{parts.netloc}/bot<token>/{parts.path.rsplit('/', 1)[-1]}"
+        path = "/".join(
+            "<id>" if segment.isdigit() else segment
+            for segment in parts.path.split("/")
+        )
+        return parts.netloc + path
+
+    def pool_stats(self) -> dict:
+        """How close each host is to its concurrency cap"""
+        return {
+            host: {
+                "in_flight": self.in_flight[host],
+                "waiting": self.waiting[host],
+                "saturated": self.saturated[host],
+                "limit": bot_settings.BACKEND_HOST_CONCURRENCY,
+            }
+            for host in self.semaphores
+        }
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        params: dict = None,
+        data: dict = None,
+        timeout: float = None,
+        retries: int = 0,
+    ) -> tuple[dict, int]:
+        """
+        Send a request through the host's circuit breaker, retrying connection
+        errors, timeouts and 5xx responses up to `retries` times
+        """
+        host = urlsplit(url).netloc
+        breaker = self.breakers.setdefault(
+            host,
+            CircuitBreaker(
+                host,
+                bot_settings.CIRCUIT_FAILURE_THRESHOLD,
+                bot_settings.CIRCUIT_RESET_TIMEOUT,
+            ),
+        )
+        client_timeout = aiohttp.ClientTimeout(
+            total=timeout or bot_settings.BACKEND_TIMEOUT
+        )
+        endpoint = self.get_endpoint(url)
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                metrics.inc(
+                    "backend_errors_total", endpoint=endpoint, error="circuit_open"
+                )
+                raise CircuitOpenError(host)
+            try:
+                with metrics.timer(
+                    "backend_request_seconds", endpoint=endpoint, method=method
+                ):
+                    async with self.host_slot(url):
+                        async with self.session.request(
+                            method,
+                            url,
+                            params=params,
+                            json=data,
+                            timeout=client_timeout,
+                        ) as response:
+                            result = await response.json(), response.status
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                metrics.inc(
+                    "backend_errors_total", endpoint=endpoint, error=type(e).__name__
+                )
+                breaker.record_failure()
+                if attempt == retries:
+                    raise
+            else:
+                if result[1] < 500:
+                    breaker.record_success()
+                    return result
+                metrics.inc(
+                    "backend_errors_total", endpoint=endpoint, error=str(result[1])
+                )
+                breaker.record_failure()
+                if attempt == retries:
+                    return result
+            delay = bot_settings.BACKEND_RETRY_BACKOFF * 2**attempt
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+    async def fetch_data(
+        self, url: str, params: dict = None, cache: bool = True, timeout: float = None
+    ) -> tuple[dict, int] | tuple[None, None]:
+        """
+        Make GET request to backend, responses of endpoints in CACHE_TTLS are
+        cached per url and params and tagged with the account they belong to.
+        Concurrent calls for the same url and params share one request
+        """
+        base_url, query = ResponseCache.split_url(url, params)
+        key = ResponseCache.make_key(url, params)
+        ttl = bot_settings.CACHE_TTLS.get(base_url) if cache else None
+        if ttl and (cached := response_cache.get(key)) is not None:
+            return cached
+
+        task = self.pending_reads.get(key)
+        if task is None:
+            tags = [f"account:{query['account_id']}"] if "account_id" in query else []
+            task = asyncio.ensure_future(
+                self.load(key, url, params, ttl, tags, timeout)
+            )
+            self.pending_reads[key] = task
+            self.pending_tags[key] = tags
+            task.add_done_callback(partial(self.forget_read, key))
+        else:
+            self.coalesced_reads += 1
+        # A caller that gives up must not cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def load(
+        self,
+        key: str,
+        url: str,
+        params: dict | None,
+        ttl: float | None,
+        tags: list[str],
+        timeout: float | None,
+    ) -> tuple[dict, int] | tuple[None, None]:
+        """
+        Send the GET request and cache the response. When the backend fails an
+        expired cached response is served if present
+        """
+        generations = [self.generations[tag] for tag in tags]
+        try:
+            result = await self.request(
+                "GET",
+                url,
+                params=params,
+                timeout=timeout,
+                retries=bot_settings.BACKEND_RETRIES,
+            )
+        except Exception as e:
+            logger.error(f"Error fetching data: {type(e).__name__} {str(e)}")
+            result = None, None
+        if ttl and (result[1] is None or result[1] >= 500):
+            return response_cache.get(key, allow_stale=True) or result
+        # A write of the account during the request may not be in the response
+        fresh = generations == [self.generations[tag] for tag in tags]
+        if ttl and result[1] == 200 and fresh:
+            response_cache.set(key, result, ttl, tags)
+        return result
+
+    def forget_read(self, key: str, task: asyncio.Future):
+        if self.pending_reads.get(key) is task:
+            del self.pending_reads[key]
+            del self.pending_tags[key]
+
+    def invalidate(self, account_id: str | None):
+        """
+        Drop cached responses of the account after a write. Reads of the
+        account in flight are no longer joined, later callers send a new one
+        """
+        if account_id is None:
+            return
+        tag = f"account:{account_id}"
+        self.generations[tag] += 1
+        response_cache.invalidate(tag)
+        for key, tags in list(self.pending_tags.items()):
+            if tag in tags:
+                del self.pending_reads[key]
+                del self.pending_tags[key]
+
+    async def post_data(
+        self,
+        url: str,
+        data: dict,
+        params: dict = None,
+        account_id: str = None,
+        timeout: float = None,
+    ) -> tuple[dict, int] | tuple[None, None]:
+        """Make POST request to backend, never retried"""
+        try:
+            return await self.request(
+                "POST", url, params=params, data=data, timeout=timeout
+            )
+        except Exception as e:
+            logger.error(f"Error posting data: {type(e).__name__} {str(e)}")
+            return None, None
+        finally:
+            self.invalidate(account_id)
+
+    async def patch_data(
+        self,
+        url: str,
+        data: dict,
+        params: dict = None,
+        account_id: str = None,
+        timeout: float = None,
+        idempotent: bool = False,
+    ) -> tuple[dict, int] | tuple[None, None]:
+        """Make PATCH request to backend, retried only when `idempotent`"""
+        try:
+            return await self.request(
+                "PATCH",
+                url,
+                params=params,
+                data=data,
+                timeout=timeout,
+                retries=bot_settings.BACKEND_RETRIES if idempotent else 0,
+            )
+        except Exception as e:
+            logger.error(f"Error patching data: {type(e).__name__} {str(e)}")
+            return None, None
+        finally:
+            self.invalidate(account_id)
+
+
+@lru_cache
+def get_backend_client() -> BackendClient:
+    return BackendClient()
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+import time
+from uuid import uuid4
+
+from .outbox import OutboundMessage, Outbox
+from .redis_connection import get_redis, RedisConnection
+from .registry import get_bot_registry, BotRegistry
+from .settings import get_settings, Settings
+from .task_manager import get_task_manager, TaskManager
+
+bot_settings: Settings = get_settings()
+redis_client: RedisConnection = get_redis()
+task_manager: TaskManager = get_task_manager()
+registry: BotRegistry = get_bot_registry()
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastStalledError(Exception):
+    """The queued messages of a broadcast stopped being sent"""
+
+
+class BroadcastStatus:
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+
+class Broadcast:
+    """
+    Sends one message to every subscriber of a bot.
+
+    Subscribers are streamed from the backend page by page, so only one page is
+    held in memory, and each page is queued in the bot's outbox together with
+    the checkpoint of the next page, a restarted broadcast continues from the
+    first page that wasn't queued. The outbox counts sent, failed and blocked
+    messages in the broadcast's hash as it sends them.
+    """
+
+    ACTIVE_KEY: str = "broadcasts:active"
+    # Seconds between checks of the messages still queued
+    POLL_INTERVAL: float = 1.0
+
+    def __init__(
+        self,
+        broadcast_id: str,
+        bot,
+        message: str,
+        owner_id: int,
+        page: int = 1,
+        sent: int = 0,
+        failed: int = 0,
+        blocked: int = 0,
+        queued: int = 0,
+    ):
+        self.broadcast_id: str = broadcast_id
+        self.bot = bot
+        self.message: str = message
+        self.owner_id: int = owner_id
+        self.page: int = page
+        self.sent: int = sent
+        self.failed: int = failed
+        self.blocked: int = blocked
+        self.queued: int = queued
+        self.status: str = BroadcastStatus.RUNNING
+        # Runs that crashed, the task manager restarts the broadcast after each
+        self.crashes: int = 0
+
+    def __str__(self):
+        return f"Broadcast {self.broadcast_id} of bot {self.bot.bot_id}"
+
+    @property
+    def task_id(self) -> str:
+        """Task id prefixed with the bot id, so the bot's broadcasts can be stopped"""
+        return f"{self.bot.bot_id}:{self.broadcast_id}"
+
+    @staticmethod
+    def get_key(broadcast_id: str) -> str:
+        return f"broadcast:{broadcast_id}"
+
+    def to_dict(self) -> dict:
+        return {
+            "bot_id": self.bot.bot_id,
+            "message": self.message,
+            "owner_id": self.owner_id,
+            "page": self.page,
+            "sent": self.sent,
+            "failed": self.failed,
+            "blocked": self.blocked,
+            "queued": self.queued,
+            "status": self.status,
+        }
+
+    def write(self, pipe):
+        """
+        Add the checkpoint to a pipeline. The counters are left out, the outbox
+        increments them
+        """
+        pipe.hset(
+            self.get_key(self.broadcast_id),
+            mapping={
+                "bot_id": self.bot.bot_id,
+                "message": self.message,
+                "owner_id": self.owner_id,
+                "page": self.page,
+                "status": self.status,
+            },
+        )
+        if self.status == BroadcastStatus.RUNNING:
+            pipe.sadd(self.ACTIVE_KEY, self.broadcast_id)
+        else:
+            pipe.srem(self.ACTIVE_KEY, self.broadcast_id)
+
+    async def save(self):
+        """Checkpoint progress, active broadcasts are resumed on startup"""
+        async with redis_client.pipeline(transaction=True) as pipe:
+            self.write(pipe)
+            await pipe.execute()
+
+    async def refresh(self):
+        """Read the counters the outbox updated"""
+        counters = await redis_client.hmget(
+            self.get_key(self.broadcast_id), "sent", "failed", "blocked", "queued"
+        )
+        self.sent, self.failed, self.blocked, self.queued = (
+            int(value or 0) for value in counters
+        )
+
+    @classmethod
+    async def load(cls, broadcast_id: str, main_bot) -> "Broadcast | None":
+        data = await redis_client.hgetall(cls.get_key(broadcast_id))
+        if not data:
+            return None
+        data = {key.decode(): value.decode() for key, value in data.items()}
+        bot = main_bot.get_bot_object(data["bot_id"])
+        if bot is None:
+            return None
+        return cls(
+            broadcast_id,
+            bot,
+            data["message"],
+            int(data["owner_id"]),
+            page=int(data["page"]),
+            sent=int(data.get("sent", 0)),
+            failed=int(data.get("failed", 0)),
+            blocked=int(data.get("blocked", 0)),
+            queued=int(data.get("queued", 0)),
+        )
+
+    async def fetch_page(self) -> tuple[list[int], bool]:
+        """Return subscriber ids of the current page and whether more pages exist"""
+        response, status_code = await self.bot.backend.fetch_data(
+            bot_settings.SUBSCRIBERS_URL,
+            params={
+                "bot_id": self.bot.bot_id,
+                "page": self.page,
+                "page_size": bot_settings.BROADCAST_PAGE_SIZE,
+            },
+        )
+        if status_code != 200:
+            raise RuntimeError(f"Fetching subscribers failed with {status_code}")
+        return (
+            [subscriber["id"] for subscriber in response.get("results", [])],
+            bool(response.get("next")),
+        )
+
+    async def enqueue(self, recipients: list[int]):
+        """Queue a page in the outbox and checkpoint the next page atomically"""
+        self.page += 1
+        try:
+            await self.queue_page(recipients)
+        except BaseException:
+            # The page wasn't queued, a restart sends it again
+            self.page -= 1
+            raise
+
+    async def queue_page(self, recipients: list[int]):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            Outbox.queue(
+                pipe,
+                (
+                    OutboundMessage(
+                        self.bot.bot_id,
+                        chat_id,
+                        self.message,
+                        progress_key=self.get_key(self.broadcast_id),
+                    )
+                    for chat_id in recipients
+                ),
+            )
+            pipe.hincrby(self.get_key(self.broadcast_id), "queued", len(recipients))
+            self.write(pipe)
+            await pipe.execute()
+
+    async def wait_for_outbox(self, limit: int):
+        """
+        Wait until at most `limit` messages of the broadcast are unsent. Raise
+        BroadcastStalledError when nothing can send them anymore or none was
+        sent for BROADCAST_STALL_TIMEOUT seconds
+        """
+        await self.refresh()
+        queued, progressed_at = self.queued, time.monotonic()
+        while self.queued > limit:
+            if registry.get(self.bot.bot_id) is not self.bot:
+                raise BroadcastStalledError(f"{self.bot} doesn't run here anymore")
+            if not await redis_client.xlen(Outbox.get_key(self.bot.bot_id)):
+                raise BroadcastStalledError(
+                    f"{self.queued} queued messages are gone from the outbox"
+                )
+            if time.monotonic() - progressed_at > bot_settings.BROADCAST_STALL_TIMEOUT:
+                raise BroadcastStalledError(
+                    f"no message sent for {bot_settings.BROADCAST_STALL_TIMEOUT}s, "
+                    f"{self.queued} left"
+                )
+            await asyncio.sleep(self.POLL_INTERVAL)
+            await self.refresh()
+            if self.queued < queued:
+                queued, progressed_at = self.queued, time.monotonic()
+
+    async def run(self):
+        logger.info(f"{self} started from page {self.page}")
+        try:
+            has_next = True
+            while has_next:
+                # Keep about one page ahead of the sends
+                await self.wait_for_outbox(bot_settings.BROADCAST_PAGE_SIZE)
+                recipients, has_next = await self.fetch_page()
+                await self.enqueue(recipients)
+            await self.wait_for_outbox(0)
+            self.status = BroadcastStatus.FINISHED
+        except BroadcastStalledError as e:
+            # Nothing sends the queued messages, a restart doesn't help
+            logger.error(f"{self} stopped: {str(e)}")
+            self.status = BroadcastStatus.FAILED
+        except Exception as e:
+            # Transient backend or redis errors, the task manager restarts the
+            # broadcast from the checkpoint of its last queued page, still
+            # RUNNING in redis, until its restarts are used up
+            self.crashes += 1
+            policy = TaskManager.POLICIES[TaskManager.BROADCASTS]
+            if self.crashes <= policy.max_restarts:
+                logger.warning(f"{self} crashed on page {self.page}: {str(e)}")
+                raise
+            logger.error(f"{self} stopped after {self.crashes} crashes: {str(e)}")
+            self.status = BroadcastStatus.FAILED
+        await self.save()
+        await self.refresh()
+        logger.info(f"{self} {self.status}: {self.to_dict()}")
+        await self.report()
+
+    async def report(self):
+        """Send the result to the owner through the main bot"""
+        from .models import get_main_bot
+
+        result = (
+            "yakunlandi" if self.status == BroadcastStatus.FINISHED else "to'xtatildi"
+        )
+        await get_main_bot().notify(
+            self.owner_id,
+            f"@{self.bot.bot_username} xabar yuborish {result}!\n"
+            f"Yuborildi: {self.sent}\n"
+            f"Xatolik: {self.failed}\n"
+            f"Bloklangan: {self.blocked}",
+        )
+
+
+async def start_broadcast(bot, message: str, owner_id: int) -> Broadcast:
+    broadcast = Broadcast(uuid4().hex, bot, message, owner_id)
+    await broadcast.save()
+    task_manager.add_task(broadcast.task_id, TaskManager.BROADCASTS, broadcast.run)
+    return broadcast
+
+
+async def resume_broadcasts(main_bot):
+    """Continue broadcasts of local bots that were interrupted or handed over"""
+    for broadcast_id in await redis_client.smembers(Broadcast.ACTIVE_KEY):
+        broadcast = await Broadcast.load(broadcast_id.decode(), main_bot)
+        if (
+            broadcast is None
+            or broadcast.task_id in task_manager.tasks.get(TaskManager.BROADCASTS)
+        ):
+            continue
+        logger.info(f"Resuming {broadcast}")
+        task_manager.add_task(broadcast.task_id, TaskManager.BROADCASTS, broadcast.run)
@@ -0,0 +1,77 @@
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of backend responses with a TTL per entry. Entries are
+    tagged, e.g. with the account they belong to, so writes can drop them
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size: int = max_size
+        # key -> (expires at, value, tags)
+        self.entries: OrderedDict[str, tuple[float, Any, list[str]]] = OrderedDict()
+        self.tags: dict[str, set[str]] = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def split_url(url: str, params: dict = None) -> tuple[str, dict]:
+        """Return the url without query and the merged query parameters"""
+        parts = urlsplit(url)
+        query = dict(parse_qsl(parts.query))
+        query.update({key: str(value) for key, value in (params or {}).items()})
+        return urlunsplit(parts._replace(query="")), query
+
+    @classmethod
+    def make_key(cls, url: str, params: dict = None) -> str:
+        base_url, query = cls.split_url(url, params)
+        return f"{base_url}?{urlencode(sorted(query.items()))}"
+
+    def get(self, key: str, allow_stale: bool = False) -> Any | None:
+        """
+        Return a fresh entry, expired entries stay until they are evicted and
+        are returned only with `allow_stale`, e.g. while the backend is down
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value, tags = entry
+        if expires_at < time.monotonic() and not allow_stale:
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float, tags: list[str] = None):
+        self.delete(key)
+        self.entries[key] = (time.monotonic() + ttl, value, tags or [])
+        for tag in tags or []:
+            self.tags.setdefault(tag, set()).add(key)
+        while len(self.entries) > self.max_size:
+            self.delete(next(iter(self.entries)))
+
+    def delete(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+    def invalidate(self, tag: str):
+        """Drop every entry with the tag"""
+        for key in list(self.tags.get(tag, ())):
+            self.delete(key)
+
+
+@lru_cache
+def get_response_cache() -> ResponseCache:
+    return ResponseCache()
@@ -17,6 +17,7 @@ async def account_add(
             "phone_number": phone,
             "username": username,
         },
+        account_id=chat_id,
     )
     if status_code == 201:
         return True
@@ -32,7 +33,7 @@ async def get_my_bots(
         my_bots, status_code = await backend.fetch_data(
             bot_settings.BOTS_URL + f"?account_id={chat_id}"
         )
-        if not any(my_bots):
+        if not my_bots:
             return None
         bots = "-----------------------------------\n"
         bots += "\n".join(
@@ -56,7 +57,7 @@ async def get_my_channels(
             bot_settings.CHANNELS_URL
             + f"?account_id={chat_id}{'&doesnt_have_bot=1' if doesnt_have_bot else ''}"
         )
-        if not any(my_channels):
+        if not my_channels:
             return None
         channels = "-----------------------------------\n"
         channels += "\n\n".join(
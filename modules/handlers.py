@@ -15,7 +15,7 @@ rate_limiter: RateLimiter = get_rate_limiter_from_memory(bot_settings.MAIN_BOT_I
 
 async def start_handler(event: Message, backend, *args, **kwargs):
     # Set the state to start
-    state.set_state(event.chat.id, MainBotStates.START)
+    await state.set_state(event.chat.id, MainBotStates.START)
 
     # Add account event start
     response = await account_add(
@@ -39,7 +39,7 @@ async def start_handler(event: Message, backend, *args, **kwargs):
             buttons=MainBotKeyboards.main_keyboard,
         )
 
-    state.set_state(event.chat.id, MainBotStates.NOTHING)
+    await state.set_state(event.chat.id, MainBotStates.NOTHING)
 
 
 async def fetch_bots_handler(event, backend, *args, **kwargs):
@@ -66,7 +66,7 @@ async def fetch_channels_handler(event, backend, *args, **kwargs):
 
 # Add channel handlers
 async def enter_channel_id(event, *args, **kwargs):
-    state.set_state(event.chat.id, MainBotStates.ENTER_CHANNEL_ID)
+    await state.set_state(event.chat.id, MainBotStates.ENTER_CHANNEL_ID)
     await rate_limiter.respond(
         event=event,
         message="Kanal ID sini kiriting:",
@@ -75,7 +75,7 @@ async def enter_channel_id(event, *args, **kwargs):
 
 
 async def enter_channel_name(event, backend, *args, **kwargs):
-    state.set_state(
+    await state.set_state(
         event.chat.id,
         MainBotStates.ENTER_CHANNEL_NAME,
         data={"channel_id": event.message.message},
@@ -89,13 +89,13 @@ async def enter_channel_name(event, backend, *args, **kwargs):
 
 
 async def complete_add_channel(event, backend, *args, **kwargs):
-    state.set_state(
+    await state.set_state(
         event.chat.id,
         MainBotStates.ADD_CHANNEL_TO_BOT,
         data={"channel_name": event.message.message},
         update=True,
     )
-    state_data = state.get_state_with_data(event.chat.id)
+    state_data = await state.get_state_with_data(event.chat.id)
     response, status_code = await backend.post_data(
         bot_settings.CHANNEL_ADD_URL,
         data={
@@ -103,6 +103,7 @@ async def complete_add_channel(event, backend, *args, **kwargs):
             "name": state_data.get("data").get("channel_name"),
             "owner": event.chat.id,
         },
+        account_id=event.chat.id,
     )
     if status_code == 201:
         await rate_limiter.respond(
@@ -116,12 +117,12 @@ async def complete_add_channel(event, backend, *args, **kwargs):
             message="Kanal qo'shishda xatolik yuz berdi!",
             buttons=MainBotKeyboards.main_keyboard,
         )
-    state.reset_state(event.chat.id)
+    await state.reset_state(event.chat.id)
 
 
 # Add bot handlers
 async def enter_bot_token(event, *args, **kwargs):
-    state.set_state(event.chat.id, MainBotStates.ENTER_BOT_TOKEN)
+    await state.set_state(event.chat.id, MainBotStates.ENTER_BOT_TOKEN)
     await rate_limiter.respond(
         event=event,
         message="Bot tokenini kiriting:",
@@ -139,10 +140,10 @@ async def assign_channel_to_bot(event, backend, *args, **kwargs):
             message="Bot topilmadi!",
             buttons=MainBotKeyboards.main_keyboard,
         )
-        state.reset_state(event.chat.id)
+        await state.reset_state(event.chat.id)
         return
     bot_data = result.get("result")
-    state.set_state(
+    await state.set_state(
         event.chat.id,
         MainBotStates.ASSIGN_CHANNEL_TO_BOT,
         data={
@@ -163,7 +164,7 @@ async def assign_channel_to_bot(event, backend, *args, **kwargs):
             message="Sizda kanallar yo'q! avval kanal qo'shing",
             buttons=MainBotKeyboards.main_keyboard,
         )
-        state.reset_state(event.chat.id)
+        await state.reset_state(event.chat.id)
         return
     await rate_limiter.respond(
         event=event, message="Botga ulash uchun kanal tanlang:", buttons=inline_keyboard
@@ -171,7 +172,7 @@ async def assign_channel_to_bot(event, backend, *args, **kwargs):
 
 
 async def complete_add_bot(event, backend, *args, **kwargs):
-    state_data = state.get_state_with_data(event.chat.id)
+    state_data = await state.get_state_with_data(event.chat.id)
     response, status_code = await backend.post_data(
         bot_settings.BOT_ADD_URL,
         data={
@@ -182,20 +183,13 @@ async def complete_add_bot(event, backend, *args, **kwargs):
             "channel_id": state_data.get("data").get("channel_id"),
             "owner": event.chat.id,
         },
+        account_id=event.chat.id,
     )
     if status_code == 201:
-        from .models import get_main_bot, MainBot, TelegramBot
+        from .models import get_main_bot, MainBot
 
         main_bot: MainBot = get_main_bot()
-        bot: TelegramBot = TelegramBot(
-            bot_id=response.get("id"),
-            bot_token=response.get("token"),
-            bot_username=response.get("username"),
-            bot_owner=response.get("owner"),
-            is_running=response.get("is_running"),
-        )
-        main_bot.bots.append(bot)
-        task_manager.add_task(response.get("id"), TaskManager.BOTS, bot.start())
+        await main_bot.start_bot(response)
 
         await rate_limiter.respond(
             event=event,
@@ -208,21 +202,21 @@ async def complete_add_bot(event, backend, *args, **kwargs):
             message="Bot qo'shishda xatolik yuz berdi!",
             buttons=MainBotKeyboards.main_keyboard,
         )
-    state.reset_state(event.chat.id)
+    await state.reset_state(event.chat.id)
 
 
 # Stop bot handlers
 async def change_bot_status_handler(event, backend, *args, **kwargs):
-    state.set_state(event.chat.id, MainBotStates.STOP_BOT)
+    await state.set_state(event.chat.id, MainBotStates.STOP_BOT)
     my_bots, status_code = await get_my_bots(event.chat.id, backend)
 
-    if not any(my_bots):
+    if not my_bots:
         await rate_limiter.respond(
             event=event,
             message="Sizda ishga tushirilgan botlar yo'q!",
             buttons=MainBotKeyboards.main_keyboard,
         )
-        state.reset_state(event.chat.id)
+        await state.reset_state(event.chat.id)
         return
 
     change_bot_status_keyboard = (
@@ -237,12 +231,51 @@ async def change_bot_status_handler(event, backend, *args, **kwargs):
 
 async def send_40_messages(event, *args, **kwargs):
     for i in range(40):
-        await rate_limiter.respond(event=event, message=f"Message {i}")
+        await rate_limiter.respond(
+            event=event, message=f"Message {i}", priority=RateLimiter.BULK
+        )
     return True
 
 
+# Broadcast handlers
+async def choose_broadcast_bot(event, backend, *args, **kwargs):
+    my_bots, status_code = await get_my_bots(event.chat.id, backend)
+
+    if not any(bot.get("is_running") for bot in my_bots or []):
+        await rate_limiter.respond(
+            event=event,
+            message="Sizda ishga tushirilgan botlar yo'q!",
+            buttons=MainBotKeyboards.main_keyboard,
+        )
+        return
+
+    await state.set_state(event.chat.id, MainBotStates.CHOOSE_BROADCAST_BOT)
+    await rate_limiter.respond(
+        event=event,
+        message="Xabar yuboriladigan botni tanlang:",
+        buttons=await MainBotInlineKeyboards.broadcast_bots_keyboard(my_bots),
+    )
+
+
+async def start_broadcast_handler(event, backend, *args, **kwargs):
+    state_data = await state.get_state_with_data(event.chat.id)
+
+    from .models import get_main_bot, MainBot
+
+    main_bot: MainBot = get_main_bot()
+    await main_bot.broadcast(
+        state_data.get("data").get("bot_id"), event.message.message, event.chat.id
+    )
+    await rate_limiter.respond(
+        event=event,
+        message="Xabar yuborish boshlandi, yakunlanganda hisobot yuboriladi.",
+        buttons=MainBotKeyboards.main_keyboard,
+    )
+    await state.reset_state(event.chat.id)
+
+
 async def cancel_handler(event, *args, **kwargs):
-    state_data = state.get_state_with_data(event.chat.id)
+    state_data = await state.get_state_with_data(event.chat.id)
     if state_data.get("state") == MainBotStates.NOTHING:
         await rate_limiter.respond(
             event=event,
@@ -250,7 +283,7 @@ async def cancel_handler(event, *args, **kwargs):
             buttons=MainBotKeyboards.main_keyboard,
         )
         return
-    state.reset_state(event.chat.id)
+    await state.reset_state(event.chat.id)
     await rate_limiter.respond(
         event=event,
         message="Amal bekor qilindi!",
@@ -261,20 +294,22 @@ async def cancel_handler(event, *args, **kwargs):
 
 async def handle_callback(event, backend, *args, **kwargs):
     data = event.data.decode().split(":")
-    state_data = state.get_state_with_data(event.chat.id)
+    state_data = await state.get_state_with_data(event.chat.id)
 
     if (
         data[0] == "assign"
         and state_data.get("state") == MainBotStates.ASSIGN_CHANNEL_TO_BOT
     ):
-        state.set_state(
+        await state.set_state(
             event.chat.id,
             MainBotStates.COMPLETE_ADD_BOT,
             data={"bot_id": data[1], "channel_id": data[2]},
             update=True,
         )
         await rate_limiter.respond(
-            event=event, message="Botga ulash uchun kanal tanlandi!"
+            event=event,
+            message="Botga ulash uchun kanal tanlandi!",
+            priority=RateLimiter.CALLBACK,
         )
         await complete_add_bot(event, backend)
 
@@ -285,6 +320,8 @@ async def handle_callback(event, backend, *args, **kwargs):
         response, status_code = await backend.patch_data(
             bot_settings.BOT_UPDATE_URL + f"{data[1]}/",
             data={"is_running": bool(int(data[2]))},
+            account_id=event.chat.id,
+            idempotent=True,
         )
         if status_code == 200:
             await rate_limiter.respond(
@@ -300,18 +337,31 @@ async def handle_callback(event, backend, *args, **kwargs):
 
             main_bot: MainBot = get_main_bot()
             if data[2] == "0":
-                main_bot.bots.remove(main_bot.get_bot_object(data[1]))
-                task_manager.remove_task(data[1], TaskManager.BOTS)
+                await main_bot.stop_bot(data[1])
             else:
-                task_manager.add_task(
-                    data[1], TaskManager.BOTS, main_bot.get_bot_object(data[1]).start()
-                )
+                await main_bot.start_bot(response)
 
-        state.reset_state(event.chat.id)
+        await state.reset_state(event.chat.id)
+
+    elif (
+        data[0] == "broadcast"
+        and state_data.get("state") == MainBotStates.CHOOSE_BROADCAST_BOT
+    ):
+        await state.set_state(
+            event.chat.id,
+            MainBotStates.ENTER_BROADCAST_MESSAGE,
+            data={"bot_id": data[1]},
+        )
+        await rate_limiter.respond(
+            event=event,
+            message="Yuboriladigan xabarni kiriting:",
+            buttons=MainBotKeyboards.cancel_keyboard,
+            priority=RateLimiter.CALLBACK,
+        )
 
     else:
         await rate_limiter.delete(event=event)
-        state.reset_state(event.chat.id)
+        await state.reset_state(event.chat.id)
 
 
 async def do_nothing(*args, **kwargs):
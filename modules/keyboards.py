@@ -24,6 +24,7 @@ class MainBotKeyboards:
             KeyboardButtonRow(
                 [
                     KeyboardButton("Bot larimni boshqarish"),
+                    KeyboardButton("Xabar yuborish"),
                 ]
             ),
             KeyboardButtonRow(
@@ -60,6 +61,23 @@ class MainBotInlineKeyboards:
             ]
         )
 
+    @staticmethod
+    async def broadcast_bots_keyboard(bots: list[dict]) -> ReplyInlineMarkup:
+        return ReplyInlineMarkup(
+            rows=[
+                KeyboardButtonRow(
+                    [
+                        KeyboardButtonCallback(
+                            text=f"{bot.get('name')} | {bot.get('username')}",
+                            data=f"broadcast:{bot.get('id')}".encode(),
+                        )
+                    ]
+                )
+                for bot in bots
+                if bot.get("is_running")
+            ]
+        )
+
     @staticmethod
     async def available_channels(
         account_id, bot_id, backend
@@ -67,7 +85,7 @@ class MainBotInlineKeyboards:
         my_channels, status_code = await get_my_channels(
             account_id, backend, doesnt_have_bot=True
         )
-        if not any(my_channels):
+        if not my_channels:
             return None
 
         return ReplyInlineMarkup(
@@ -0,0 +1,107 @@
+import logging
+import time
+from functools import lru_cache
+
+from .redis_connection import get_redis, RedisConnection
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+redis_client: RedisConnection = get_redis()
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseManager:
+    """
+    Redis leases that give every bot exactly one owner in the cluster.
+
+    Each worker heartbeats into the `workers` sorted set and renews the leases it
+    holds on every heartbeat. When a worker dies its heartbeat and its leases
+    expire after LEASE_TTL seconds, and the bots move to the next live worker.
+    """
+
+    WORKERS_KEY: str = "workers"
+
+    # Only the holder may renew or release a lease
+    RENEW_SCRIPT: str = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT: str = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id: str = worker_id
+        self.ttl: int = bot_settings.LEASE_TTL * 1000  # in milliseconds
+        self.held: set[str] = set()
+        self.renew_script = redis_client.register_script(self.RENEW_SCRIPT)
+        self.release_script = redis_client.register_script(self.RELEASE_SCRIPT)
+
+    def __repr__(self):
+        return f"LeaseManager(worker_id={self.worker_id}, held={len(self.held)})"
+
+    @staticmethod
+    def get_key(name: str) -> str:
+        return f"lease:{name}"
+
+    async def heartbeat(self) -> list[str]:
+        """Mark this worker alive and return all live workers"""
+        now = time.time()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zadd(self.WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(
+                self.WORKERS_KEY, "-inf", now - bot_settings.LEASE_TTL
+            )
+            pipe.zrange(self.WORKERS_KEY, 0, -1)
+            *_, workers = await pipe.execute()
+        return [worker.decode() for worker in workers]
+
+    async def owner(self, name: str) -> str | None:
+        owner: bytes = await redis_client.get(self.get_key(name))
+        return owner.decode() if owner else None
+
+    async def acquire(self, name: str) -> bool:
+        if await redis_client.set(
+            self.get_key(name), self.worker_id, nx=True, px=self.ttl
+        ) or await self.owner(name) == self.worker_id:
+            self.held.add(name)
+            return True
+        return False
+
+    async def renew_all(self) -> set[str]:
+        """Extend every held lease, return the leases that were lost"""
+        names = list(self.held)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for name in names:
+                await self.renew_script(
+                    keys=[self.get_key(name)],
+                    args=[self.worker_id, self.ttl],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+        lost = {name for name, renewed in zip(names, results) if not renewed}
+        self.held -= lost
+        for name in lost:
+            logger.warning(f"Lease {name} was lost by {self.worker_id}")
+        return lost
+
+    async def release(self, name: str):
+        self.held.discard(name)
+        await self.release_script(keys=[self.get_key(name)], args=[self.worker_id])
+
+    async def leave(self):
+        """Release every lease and leave the cluster so others take over at once"""
+        for name in list(self.held):
+            await self.release(name)
+        await redis_client.zrem(self.WORKERS_KEY, self.worker_id)
+
+
+@lru_cache
+def get_lease_manager() -> LeaseManager:
+    return LeaseManager(bot_settings.WORKER_ID)
@@ -0,0 +1,237 @@
+import asyncio
+import bisect
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Callable, Iterable
+
+from aiohttp import web
+
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+logger = logging.getLogger(__name__)
+
+# Returns (name, labels, value) samples when the metrics are scraped
+Collector = Callable[[], Iterable[tuple[str, dict, float]]]
+
+# Metric types and help texts, metrics not listed here are not exposed
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+SUMMARY = "summary"
+DESCRIPTIONS: dict[str, tuple[str, str]] = {
+    "bot_updates_total": (COUNTER, "Updates received per bot"),
+    "handler_seconds": (HISTOGRAM, "Time spent in message handlers"),
+    "limiter_queue_length": (GAUGE, "Messages queued in the rate limiter per lane"),
+    "limiter_wait_seconds": (SUMMARY, "Time messages waited in the rate limiter"),
+    "limiter_lane_wait_seconds": (
+        HISTOGRAM,
+        "Time messages waited in the rate limiter per lane",
+    ),
+    "limiter_sent_total": (COUNTER, "Messages sent through the rate limiter"),
+    "limiter_flood_waits_total": (COUNTER, "Flood waits hit by the rate limiter"),
+    "limiter_rate": (GAUGE, "Current send rate of the rate limiter per second"),
+    "outbox_messages_total": (COUNTER, "Outbox messages handled by outcome"),
+    "outbox_in_flight": (GAUGE, "Outbox messages being sent"),
+    "backend_request_seconds": (HISTOGRAM, "Backend request latency by endpoint"),
+    "backend_errors_total": (COUNTER, "Failed backend requests by endpoint"),
+    "backend_in_flight": (GAUGE, "Backend requests in flight per host"),
+    "backend_waiting": (GAUGE, "Backend requests waiting for a slot per host"),
+    "backend_circuit_open": (GAUGE, "1 while the circuit of a host is not closed"),
+    "redis_command_seconds": (HISTOGRAM, "Redis command latency"),
+    "tasks": (GAUGE, "Supervised tasks per group"),
+    "tasks_failed": (GAUGE, "Tasks that gave up per group"),
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed upper bounds, in seconds by default
+    """
+
+    BUCKETS: tuple[float, ...] = (
+        0.001,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+    )
+
+    def __init__(self, buckets: tuple[float, ...] = BUCKETS):
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * len(buckets)
+        self.sum: float = 0
+        self.count: int = 0
+
+    def __repr__(self):
+        return f"Histogram(count={self.count}, sum={self.sum:.3f})"
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+class Metrics:
+    """
+    Metrics of the worker in the Prometheus text format.
+
+    Counters and histograms are updated where the work happens. Gauges and
+    counters the components keep themselves are read by collectors when the
+    metrics are scraped, so the hot paths don't pay for them
+    """
+
+    def __init__(self, worker_id: str):
+        self.worker_id: str = worker_id
+        self.counters: dict[str, dict[tuple, float]] = defaultdict(dict)
+        self.histograms: dict[str, dict[tuple, Histogram]] = defaultdict(dict)
+        self.collectors: list[Collector] = []
+
+    def __repr__(self):
+        return (
+            f"Metrics(counters={len(self.counters)}, "
+            f"histograms={len(self.histograms)})"
+        )
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(labels.items())
+        self.counters[name][key] = self.counters[name].get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        histograms = self.histograms[name]
+        key = tuple(labels.items())
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the seconds the body takes, also when it raises"""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def add_collector(self, collector: Collector):
+        self.collectors.append(collector)
+
+    def collect(self) -> dict[str, list[tuple[dict, float]]]:
+        samples: dict[str, list[tuple[dict, float]]] = defaultdict(list)
+        for name, values in self.counters.items():
+            samples[name].extend((dict(key), value) for key, value in values.items())
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    samples[name].append((labels, value))
+            except Exception as e:
+                logger.error(f"Metrics collector {collector} failed: {str(e)}")
+        return samples
+
+    def render(self) -> str:
+        worker = {"worker": self.worker_id}
+        lines = []
+        samples = self.collect()
+        for name, (metric_type, help_text) in DESCRIPTIONS.items():
+            # A summary is collected as its sum and count
+            sample_names = (
+                (f"{name}_sum", f"{name}_count") if metric_type == SUMMARY else (name,)
+            )
+            if name not in self.histograms and not any(
+                sample_name in samples for sample_name in sample_names
+            ):
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            for sample_name in sample_names:
+                for labels, value in samples.get(sample_name, ()):
+                    lines.append(
+                        f"{sample_name}{format_labels({**worker, **labels})} {value}"
+                    )
+            for key, histogram in self.histograms.get(name, {}).items():
+                labels = {**worker, **dict(key)}
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        f"{name}_bucket{format_labels({**labels, 'le': bound})} "
+                        f"{cumulative}"
+                    )
+                lines.append(
+                    f"{name}_bucket{format_labels({**labels, 'le': '+Inf'})} "
+                    f"{histogram.count}"
+                )
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """
+    Serves the worker's metrics on GET /metrics. Every shard of a host listens
+    on METRICS_PORT plus its shard id
+    """
+
+    PATH: str = "/metrics"
+
+    def __init__(self, metrics: Metrics):
+        self.metrics: Metrics = metrics
+        self.app: web.Application = web.Application()
+        self.app.router.add_get(self.PATH, self.handle)
+
+    def __repr__(self):
+        return f"MetricsServer(port={self.port})"
+
+    @property
+    def port(self) -> int:
+        return bot_settings.METRICS_PORT + (bot_settings.SHARD_ID or 0)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.render(), content_type="text/plain", charset="utf-8"
+        )
+
+    async def run(self):
+        """Serve until cancelled"""
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, bot_settings.METRICS_HOST, self.port)
+        await site.start()
+        logger.info(
+            f"Metrics served on {bot_settings.METRICS_HOST}:{self.port}{self.PATH}"
+        )
+        try:
+            await asyncio.Future()
+        finally:
+            await runner.cleanup()
+
+
+@lru_cache
+def get_metrics() -> Metrics:
+    return Metrics(bot_settings.WORKER_ID)
@@ -1,17 +1,31 @@
 import asyncio
 import logging
-from functools import lru_cache
-from typing import Optional
-
-import aiohttp
+import time
+from datetime import datetime, timezone
+from functools import lru_cache, partial
 from telethon import TelegramClient, events
 
-from .task_manager import get_task_manager, TaskManager
+from .backend import get_backend_client, BackendClient
+from .task_manager import get_task_manager, TaskHealth, TaskManager
 from . import handlers
+from .broadcast import resume_broadcasts, start_broadcast
 from .redis_connection import get_redis, RedisConnection
 from .settings import get_settings, Settings
 from .state_manager import get_state_manager, StateManager
-from .rate_limiter import get_rate_limiter_from_memory, RateLimiter
+from .rate_limiter import (
+    drop_rate_limiter,
+    get_rate_limiter_from_memory,
+    RateLimitedClient,
+    RateLimiter,
+)
+from .sharding import get_shard_router, BotCommand, ShardRouter
+from .leases import get_lease_manager, LeaseManager
+from .metrics import get_metrics, Metrics, MetricsServer
+from .outbox import get_outbox, Outbox
+from .registry import get_bot_registry, BotRegistry
+from .routing import Router
+from .startup import get_login_scheduler, LoginScheduler
+from .webhook import BotApi, WebhookEvent, WebhookServer
 
 # Define global settings
 bot_settings: Settings = get_settings()
@@ -25,54 +39,23 @@ redis_client: RedisConnection = get_redis()
 # Define a global task manager
 task_manager: TaskManager = get_task_manager()
 
-logger = logging.getLogger(__name__)
-
-
-class BackendClient:
-    def __init__(self):
-        self.session: Optional[aiohttp.ClientSession] = None
+# Define a global shard router and lease manager
+shard_router: ShardRouter = get_shard_router()
+leases: LeaseManager = get_lease_manager()
 
-    async def init_session(self):
-        if not self.session:
-            self.session = aiohttp.ClientSession()
+# Define a global registry of the bots hosted by this worker
+registry: BotRegistry = get_bot_registry()
 
-    async def close_session(self):
-        if self.session:
-            await self.session.close()
-            self.session = None
+# Define a global scheduler of bot logins
+login_scheduler: LoginScheduler = get_login_scheduler()
 
-    async def fetch_data(
-        self, url: str, params: dict = None
-    ) -> tuple[dict, int] | tuple[None, None]:
-        """Make GET request to backend"""
-        try:
-            async with self.session.get(url, params=params) as response:
-                return await response.json(), response.status
-        except Exception as e:
-            logger.error(f"Error fetching data: {str(e)}")
-            return None, None
+# Define a global outbox of the bots hosted by this worker
+outbox: Outbox = get_outbox()
 
-    async def post_data(
-        self, url: str, data: dict, params: dict = None
-    ) -> tuple[dict, int] | tuple[None, None]:
-        """Make POST request to backend"""
-        try:
-            async with self.session.post(url, params=params, json=data) as response:
-                return await response.json(), response.status
-        except Exception as e:
-            logger.error(f"Error posting data: {str(e)}")
-            return None, None
+# Define global metrics
+metrics: Metrics = get_metrics()
 
-    async def patch_data(
-        self, url: str, data: dict, params: dict = None
-    ) -> tuple[dict, int] | tuple[None, None]:
-        """Make PATCH request to backend"""
-        try:
-            async with self.session.patch(url, params=params, json=data) as response:
-                return await response.json(), response.status
-        except Exception as e:
-            logger.error(f"Error patching data: {str(e)}")
-            return None, None
+logger = logging.getLogger(__name__)
 
 
 class Bot:
@@ -85,7 +68,7 @@ class Bot:
         id: str,
         token: str,
         username: str,
-        client: TelegramClient,
+        client: TelegramClient | None,
         bot_owner: dict = None,
         is_running: bool = False,
     ):
@@ -93,12 +76,22 @@ class Bot:
         self.bot_token: str = token
         self.bot_username: str = username
         self.bot_owner: dict = bot_owner or {"id": None, "name": None, "username": None}
-        self.session: Optional[aiohttp.ClientSession] = None
-        self.backend: BackendClient = BackendClient()
-        self.client: TelegramClient = client
+        self.backend: BackendClient = get_backend_client()
+        self.client: TelegramClient | None = client
         self.is_running: bool = is_running
         self.rate_limiter: RateLimiter | None = None
-        self.is_first_message = True
+        # Set once the client is logged in and can send messages
+        self.ready: asyncio.Event = asyncio.Event()
+        # Hibernation, see TelegramBot.start
+        self.last_activity: float = time.monotonic()
+        self.wake_up: asyncio.Event = asyncio.Event()
+        # Cleared on shutdown, updates are no longer handled
+        self.accepting_updates: bool = True
+        # Logins with a lower priority go first, see LoginScheduler
+        self.login_priority: float = 0
+        # Updates received, and how many of them are recorded in redis
+        self.updates: int = 0
+        self.recorded_updates: int = 0
 
     def __str__(self):
         return f"Bot {self.bot_id}"
@@ -117,17 +110,35 @@ class Bot:
 
     async def start(self):
         """Start the bot"""
-        if not self.session:
-            logger.info(f"Initializing session... for bot {self.bot_id}")
-            await self.backend.init_session()
-        await self.client.start(bot_token=self.bot_token)
+        await self.backend.init_session()
+        async with login_scheduler.slot(self.login_priority):
+            await self.client.start(bot_token=self.bot_token)
+        self.ready.set()
 
         try:
             logger.info(f"Bot {self.bot_id} is running...")
             self.is_running = True
+            registry.set_running(self.bot_id, True)
             await self.client.run_until_disconnected()
         finally:
-            await self.backend.close_session()
+            self.ready.clear()
+            self.is_running = False
+            registry.set_running(self.bot_id, False)
+            if self.client.is_connected():
+                await self.client.disconnect()
+
+    async def send_message(self, chat_id: int, message: str, **kwargs):
+        return await self.client.send_message(chat_id, message, **kwargs)
+
+    def touch(self):
+        """Mark the bot as active, postponing hibernation"""
+        self.last_activity = time.monotonic()
+
+    async def connected(self):
+        """Wake the bot up if it hibernates and wait until it can send messages"""
+        self.touch()
+        self.wake_up.set()
+        await self.ready.wait()
 
 
 class MainBot(Bot):
@@ -144,6 +155,7 @@ class MainBot(Bot):
         "Bekor qilish": handlers.cancel_handler,
         "Bot larimni boshqarish": handlers.change_bot_status_handler,
         "40 ta xabar yubor": handlers.send_40_messages,
+        "Xabar yuborish": handlers.choose_broadcast_bot,
     }
 
     STATE_COMMANDS = {
@@ -153,6 +165,8 @@ class MainBot(Bot):
         # adding bot
         "enter_bot_token": handlers.assign_channel_to_bot,
         "assign_channel_to_bot": handlers.complete_add_bot,
+        # broadcast
+        "enter_broadcast_message": handlers.start_broadcast_handler,
     }
 
     def __init__(self):
@@ -160,11 +174,27 @@ class MainBot(Bot):
             id=bot_settings.MAIN_BOT_ID,
             token=bot_settings.MAIN_BOT_TOKEN,
             username=bot_settings.MAIN_BOT_USERNAME,
-            client=TelegramClient(
-                "sessions/main_session", bot_settings.API_ID, bot_settings.API_HASH
+            client=RateLimitedClient(
+                "sessions/main_session",
+                bot_settings.API_ID,
+                bot_settings.API_HASH,
+                flood_sleep_threshold=bot_settings.FLOOD_SLEEP_THRESHOLD,
             ),
         )
-        self.bots: list[TelegramBot] = []
+        self.bots: BotRegistry = registry
+        self.rebalance_lock: asyncio.Lock = asyncio.Lock()
+        # Set under rebalance_lock once shutdown starts, no bot starts after it
+        self.shutting_down: bool = False
+        # The main bot logs in before every tenant bot
+        self.login_priority = float("-inf")
+        # Cold start timings, see startup_report
+        self.started_at: float = time.monotonic()
+        self.timings: dict[str, float] = {}
+        self.webhook_server: WebhookServer | None = None
+        self.shutdown_task: asyncio.Task | None = None
+        # Unix time of the last sync of active bots with the backend
+        self.synced_at: float | None = None
+        self.full_synced_at: float = 0
         self.setup_handlers()
 
     def __getitem__(self, item):
@@ -177,7 +207,7 @@ class MainBot(Bot):
         return iter(self.bots)
 
     def __contains__(self, item):
-        return any(bot.bot_id == item for bot in self.bots)
+        return item in self.bots
 
     def __str__(self):
         return f"Main Bot {self.bot_id}"
@@ -189,90 +219,503 @@ class MainBot(Bot):
         # handle all messages
         @self.client.on(events.NewMessage())
         async def dispatcher_handler(event: events.NewMessage.Event):
-            state_data = state.get_state_with_data(event.chat.id)
-            if not await MainBot.COMMANDS.get(
-                event.message.message, handlers.do_nothing
-            )(event, self.backend):
-                if self.is_first_message:
-                    self.is_first_message = False
-                    periodic_check_task = get_rate_limiter_from_memory(
-                        bot_id=self.bot_id, bot_username=self.bot_username
-                    ).periodic_check
-                    task_manager.add_task(
-                        self.bot_id, TaskManager.RATE_LIMITER, periodic_check_task()
-                    )
+            if not self.accepting_updates:
                 return
+            self.updates += 1
+            # Menu commands don't depend on the state, it is read only when a
+            # command hands the message on or the message isn't a command
+            command = MainBot.COMMANDS.get(event.message.message, handlers.do_nothing)
+            with metrics.timer("handler_seconds", bot="main", handler=command.__name__):
+                if not await command(event, self.backend):
+                    return
+            state_data = await state.get_state_with_data(event.chat.id)
             if state_data:
-                await MainBot.STATE_COMMANDS.get(
+                state_command = MainBot.STATE_COMMANDS.get(
                     state_data.get("state"), handlers.do_nothing
-                )(event, self.backend)
+                )
+                with metrics.timer(
+                    "handler_seconds", bot="main", handler=state_command.__name__
+                ):
+                    await state_command(event, self.backend)
 
         # handle all callbacks
         @self.client.on(events.callbackquery.CallbackQuery())
         async def callback_handler(event: events.callbackquery.CallbackQuery.Event):
-            await handlers.handle_callback(event, self.backend)
+            if not self.accepting_updates:
+                return
+            self.updates += 1
+            with metrics.timer(
+                "handler_seconds", bot="main", handler="handle_callback"
+            ):
+                await handlers.handle_callback(event, self.backend)
 
-    async def fetch_bots(self):
-        """Fetch all bots from the backend and initialize TelegramBot instances"""
+    async def fetch_bots(self) -> list[dict]:
+        """
+        Fetch all bots from the backend and publish the running ones to redis,
+        each worker starts the bots it wins leases for in `rebalance`
+        """
         logger.info("Fetching bots...")
-        bots, status_code = await self.backend.fetch_data(bot_settings.BOTS_URL)
-        self.bots = [
-            TelegramBot(
-                bot_id=bot["id"],
-                bot_token=bot["token"],
-                bot_username=bot["username"],
-                bot_owner=bot["owner"],
-                is_running=bot["is_running"],
+        bots, status_code = await self.backend.fetch_data(
+            bot_settings.BOTS_URL, cache=False
+        )
+        if status_code != 200:
+            raise RuntimeError(f"Fetching bots failed with {status_code}")
+        logger.info(f"Fetched {len(bots)} bots.")
+        await redis_client.set_active_bots(
+            [self.get_bot_data(bot) for bot in bots if bot["is_running"]]
+        )
+        return bots
+
+    async def sync_bots(self):
+        """
+        Apply the bots changed in the backend since the last sync to the active
+        bots in redis. The whole list is fetched every BOTS_FULL_SYNC_INTERVAL
+        to also drop deleted bots
+        """
+        started_at = time.time()
+        if started_at - self.full_synced_at >= bot_settings.BOTS_FULL_SYNC_INTERVAL:
+            await self.fetch_bots()
+            self.full_synced_at = started_at
+        else:
+            bots, status_code = await self.backend.fetch_data(
+                bot_settings.BOTS_URL,
+                params={
+                    "updated_since": datetime.fromtimestamp(
+                        self.synced_at, tz=timezone.utc
+                    ).isoformat()
+                },
+                cache=False,
+            )
+            if status_code != 200:
+                raise RuntimeError(f"Fetching changed bots failed with {status_code}")
+            await redis_client.update_active_bots(
+                started=[self.get_bot_data(bot) for bot in bots if bot["is_running"]],
+                stopped=[bot["id"] for bot in bots if not bot["is_running"]],
             )
-            for bot in bots
-        ]
-        logger.info(f"Fetched {len(self.bots)} bots.")
-        redis_client.set_active_bots(
-            [bot.to_dict() for bot in self.bots if bot.is_running]
+            if bots:
+                logger.info(f"{len(bots)} bots changed since the last sync")
+        self.synced_at = started_at
+        await shard_router.publish_all({"action": BotCommand.REBALANCE})
+
+    async def sync_loop(self):
+        """The worker running the main bot keeps the active bots in sync"""
+        while True:
+            await asyncio.sleep(bot_settings.BOTS_SYNC_INTERVAL)
+            if ShardRouter.MAIN_BOT_KEY not in leases.held:
+                continue
+            try:
+                await self.sync_bots()
+            except Exception as e:
+                logger.error(f"Error syncing bots: {str(e)}")
+
+    @staticmethod
+    def get_bot_data(bot: dict) -> dict:
+        """Fields of a backend bot that workers need to run it"""
+        return {
+            "id": bot["id"],
+            "token": bot["token"],
+            "username": bot["username"],
+            "owner": bot["owner"],
+            "is_running": bot["is_running"],
+            "transport": bot.get("transport"),
+        }
+
+    def run_bot(self, bot: Bot):
+        """Add the bot and its rate limiter workers to the task manager"""
+        task_manager.add_task(bot.bot_id, TaskManager.BOTS, bot.start)
+        bot.rate_limiter = get_rate_limiter_from_memory(
+            bot_id=bot.bot_id, bot_username=bot.bot_username
         )
+        bot.rate_limiter.start()
 
     async def start_bots(self):
         """
         This function is the main loop that starts all bots and all tasks
         """
-        # Start main bot
-        task_manager.add_task(self.bot_id, TaskManager.BOTS, self.start())
-        # Add rate limiter task
-        self.rate_limiter = get_rate_limiter_from_memory(
-            bot_id=self.bot_id, bot_username=self.bot_username
+        # Receive commands for the bots of this worker from other workers
+        task_manager.add_task(
+            shard_router.worker_id,
+            TaskManager.SERVICES,
+            partial(shard_router.listen, self.handle_bot_command),
+        )
+        # Join the cluster and take over the bots this worker owns
+        task_manager.add_task(
+            LeaseManager.WORKERS_KEY, TaskManager.SERVICES, self.cluster_loop
         )
-        # task_manager.add_task(self.bot_id, TaskManager.RATE_LIMITER, self.rate_limiter.periodic_check())
+        # Pick up bots added, changed or removed in the backend
+        task_manager.add_task("sync_bots", TaskManager.SERVICES, self.sync_loop)
+        # Send the queued bulk messages of the local bots
+        task_manager.add_task(
+            "outbox", TaskManager.SERVICES, partial(outbox.run, self.bots)
+        )
+        # Serve metrics
+        if bot_settings.METRICS_PORT:
+            metrics.add_collector(self.collect_metrics)
+            task_manager.add_task(
+                "metrics", TaskManager.SERVICES, MetricsServer(metrics).run
+            )
+        # Receive updates of webhook bots
+        if bot_settings.WEBHOOK_URL:
+            self.webhook_server = WebhookServer(self.handle_update)
+            task_manager.add_task(
+                "webhook", TaskManager.SERVICES, self.webhook_server.run
+            )
+
+        # Run all tasks
+        await task_manager.run_all_tasks_in_main_loop()
+
+    # Cluster membership
+    async def cluster_loop(self):
+        """Heartbeat and rebalance bots between the live workers"""
+        try:
+            while True:
+                try:
+                    await self.rebalance()
+                    await self.record_activity()
+                except Exception as e:
+                    logger.error(f"Error rebalancing bots: {str(e)}")
+                await asyncio.sleep(bot_settings.HEARTBEAT_INTERVAL)
+        finally:
+            await leases.leave()
+
+    async def rebalance(self):
+        """
+        Renew leases, start the bots this worker owns on the hash ring and hand
+        over the bots that now belong to another worker. Bots that are already
+        running and unchanged are left connected
+        """
+        async with self.rebalance_lock:
+            if self.shutting_down:
+                # Keep the bots draining here until they disconnect
+                await leases.renew_all()
+                return
+            shard_router.set_members(await leases.heartbeat())
+            for name in await leases.renew_all():
+                if name == ShardRouter.MAIN_BOT_KEY:
+                    await task_manager.stop_task(self.bot_id, TaskManager.BOTS)
+                else:
+                    await self.stop_local(name.removeprefix("bot:"))
+
+            # Main bot
+            main_bot_running = self.bot_id in task_manager.tasks.get(TaskManager.BOTS)
+            if shard_router.owns(ShardRouter.MAIN_BOT_KEY):
+                if not main_bot_running and await leases.acquire(
+                    ShardRouter.MAIN_BOT_KEY
+                ):
+                    logger.info(f"{self} is taken over by {shard_router.worker_id}")
+                    # States cached while another worker ran the main bot are stale
+                    state.clear_cache()
+                    self.run_bot(self)
+            elif main_bot_running:
+                await task_manager.stop_task(self.bot_id, TaskManager.BOTS)
+                await leases.release(ShardRouter.MAIN_BOT_KEY)
+
+            # Tenant bots
+            owned = {
+                str(bot["id"]): bot
+                for bot in await redis_client.get_active_bots()
+                if shard_router.owns(bot["id"])
+            }
+            for bot in self.bots:
+                bot_data = owned.get(str(bot.bot_id))
+                if bot_data is None:
+                    await self.stop_local(bot.bot_id)
+                    await leases.release(f"bot:{bot.bot_id}")
+                elif bot_data["token"] != bot.bot_token or (
+                    bot_data.get("transport") or bot_settings.BOT_TRANSPORT
+                ) != bot.transport:
+                    # Token or transport was changed in the backend, reconnect
+                    # only this bot
+                    await self.stop_local(bot.bot_id)
+            # The busiest bots log in first
+            new_bots = [bot_id for bot_id in owned if bot_id not in self]
+            activity = dict(
+                zip(new_bots, await redis_client.get_bot_activity(new_bots))
+            )
+            started = []
+            for bot_id in sorted(new_bots, key=activity.get, reverse=True):
+                if await leases.acquire(f"bot:{bot_id}"):
+                    started.append(
+                        self.start_local(owned[bot_id], priority=-activity[bot_id])
+                    )
 
-        # Add all bots to task manager
+            if "rebalance" not in self.timings:
+                self.timings["rebalance"] = time.monotonic() - self.started_at
+                report_bots = list(started)
+                if self.bot_id in task_manager.tasks.get(TaskManager.BOTS):
+                    report_bots.append(self)
+                task_manager.add_task(
+                    "startup_report",
+                    TaskManager.SERVICES,
+                    self.startup_report(report_bots),
+                )
+
+            # Continue broadcasts of bots that were taken over
+            if started:
+                await resume_broadcasts(self)
+
+    async def record_activity(self):
+        """Add the updates bots received since the last call to redis"""
+        updates = {}
         for bot in self.bots:
-            if bot.is_running:
-                # Start bot
-                task_manager.add_task(bot.bot_id, TaskManager.BOTS, bot.start())
-                # Add rate limiter task
-                bot.rate_limiter = get_rate_limiter_from_memory(
-                    bot_id=bot.bot_id, bot_username=bot.bot_username
+            if bot.updates > bot.recorded_updates:
+                updates[bot.bot_id] = bot.updates - bot.recorded_updates
+                bot.recorded_updates = bot.updates
+        if updates:
+            await redis_client.add_bot_activity(updates)
+
+    async def startup_report(self, bots: list[Bot]):
+        """Log how long the cold start took until the bots were online"""
+        online = 0
+        if bots:
+            done, pending = await asyncio.wait(
+                [asyncio.ensure_future(bot.ready.wait()) for bot in bots],
+                timeout=bot_settings.STARTUP_REPORT_TIMEOUT,
+            )
+            for future in pending:
+                future.cancel()
+            online = len(done)
+        logger.info(
+            f"Cold start: {online}/{len(bots)} bots online in "
+            f"{time.monotonic() - self.started_at:.1f}s, "
+            f"fetching bots {self.timings.get('fetch_bots', 0):.1f}s, "
+            f"first rebalance {self.timings['rebalance']:.1f}s, "
+            f"logins {login_scheduler.stats()}"
+        )
+
+    def collect_metrics(self):
+        """Samples of the counters and gauges the components keep themselves"""
+        for bot in [self, *self.bots]:
+            yield "bot_updates_total", {"bot_id": bot.bot_id}, bot.updates
+            if bot.rate_limiter is None:
+                continue
+            labels = {"bot_id": bot.bot_id}
+            stats = bot.rate_limiter.stats()
+            for lane, length in stats["lanes"].items():
+                yield "limiter_queue_length", {**labels, "lane": lane}, length
+            yield "limiter_wait_seconds_sum", labels, bot.rate_limiter.WAIT_SECONDS
+            yield "limiter_wait_seconds_count", labels, bot.rate_limiter.WAITED_JOBS
+            yield "limiter_sent_total", labels, stats["sent"]
+            yield "limiter_flood_waits_total", labels, stats["flood_waits"]
+            yield "limiter_rate", labels, stats["rate"]
+
+        for outcome, count in outbox.stats().items():
+            if outcome == "in_flight":
+                yield "outbox_in_flight", {}, count
+            else:
+                yield "outbox_messages_total", {"outcome": outcome}, count
+
+        for host, stats in self.backend.pool_stats().items():
+            yield "backend_in_flight", {"host": host}, stats["in_flight"]
+            yield "backend_waiting", {"host": host}, stats["waiting"]
+        for host, breaker in self.backend.breakers.items():
+            is_open = breaker.state != breaker.CLOSED
+            yield "backend_circuit_open", {"host": host}, int(is_open)
+
+        for task_group in task_manager.tasks:
+            labels = {"group": task_group}
+            yield "tasks", labels, task_manager.count(task_group)
+            failed = task_manager.count(task_group, TaskHealth.FAILED)
+            yield "tasks_failed", labels, failed
+
+    def start_local(self, bot_data: dict, priority: float = 0) -> "TelegramBot":
+        bot = TelegramBot(
+            bot_id=bot_data["id"],
+            bot_token=bot_data["token"],
+            bot_username=bot_data["username"],
+            bot_owner=bot_data.get("owner"),
+            is_running=True,
+            transport=bot_data.get("transport"),
+        )
+        bot.login_priority = priority
+        if self.bots.add(bot):
+            self.run_bot(bot)
+        return bot
+
+    async def stop_local(self, bot_id: str):
+        bot = self.bots.remove(bot_id)
+        if bot is None:
+            return
+        await task_manager.stop_task(bot.bot_id, TaskManager.BOTS)
+        for task_id in list(task_manager.tasks.get(TaskManager.BROADCASTS)):
+            if task_id.startswith(f"{bot.bot_id}:"):
+                await task_manager.stop_task(task_id, TaskManager.BROADCASTS)
+        # A bot started here again gets a new limiter with its own workers
+        await task_manager.stop_task(bot.bot_id, TaskManager.RATE_LIMITER)
+        rate_limiter = drop_rate_limiter(bot.bot_id)
+        if rate_limiter is not None:
+            rate_limiter.cancel()
+
+    # Bot commands, executed here or forwarded to the worker that owns the bot
+    async def handle_bot_command(self, command: dict):
+        action = command.get("action")
+        if action == BotCommand.START:
+            bot_id = command["bot"]["id"]
+            if self.shutting_down:
+                return
+            if str(bot_id) not in self and await leases.acquire(f"bot:{bot_id}"):
+                self.start_local(command["bot"])
+        elif action == BotCommand.STOP:
+            await self.stop_local(command["bot_id"])
+            await leases.release(f"bot:{command['bot_id']}")
+        elif action == BotCommand.BROADCAST:
+            await self.broadcast(
+                command["bot_id"], command["message"], command["owner_id"]
+            )
+        elif action == BotCommand.NOTIFY:
+            await self.notify(command["chat_id"], command["message"])
+        elif action == BotCommand.REBALANCE:
+            await self.rebalance()
+        elif action == BotCommand.UPDATE:
+            await self.handle_update(command["bot_id"], command["update"])
+
+    async def start_bot(self, bot_data: dict):
+        """Start a tenant bot from its backend representation"""
+        await redis_client.add_active_bot(bot_data)
+        await self.handle_or_publish(
+            shard_router.owner_of(bot_data["id"]),
+            {"action": BotCommand.START, "bot": bot_data},
+        )
+
+    async def stop_bot(self, bot_id: str):
+        await redis_client.remove_active_bot(bot_id)
+        await self.handle_or_publish(
+            await leases.owner(f"bot:{bot_id}"),
+            {"action": BotCommand.STOP, "bot_id": bot_id},
+        )
+
+    async def broadcast(self, bot_id: str, message: str, owner_id: int):
+        if bot_id not in self:
+            owner = await leases.owner(f"bot:{bot_id}")
+            if owner is None:
+                await self.notify(owner_id, "Bot ishga tushirilmagan!")
+            else:
+                await shard_router.publish(
+                    owner,
+                    {
+                        "action": BotCommand.BROADCAST,
+                        "bot_id": bot_id,
+                        "message": message,
+                        "owner_id": owner_id,
+                    },
+                )
+            return
+        await start_broadcast(self.get_bot_object(bot_id), message, owner_id)
+
+    async def notify(self, chat_id: int, message: str):
+        """Send a message to a user from the main bot"""
+        if not self.ready.is_set():
+            owner = await leases.owner(ShardRouter.MAIN_BOT_KEY)
+            if owner is None:
+                logger.warning(f"No worker runs {self}, message to {chat_id} dropped")
+                return
+            if owner != shard_router.worker_id:
+                await shard_router.publish(
+                    owner,
+                    {
+                        "action": BotCommand.NOTIFY,
+                        "chat_id": chat_id,
+                        "message": message,
+                    },
                 )
-                # task_manager.add_task(bot.bot_id, TaskManager.RATE_LIMITER, bot.rate_limiter.periodic_check())
+                return
+        await self.rate_limiter.submit(
+            chat_id, lambda: self.client.send_message(chat_id, message)
+        )
 
-        # Run all tasks
-        await task_manager.run_all_tasks_in_main_loop()
+    async def handle_update(self, bot_id: str, update: dict):
+        """Handle a webhook update here or forward it to the worker running the bot"""
+        bot = self.get_bot_object(bot_id)
+        if bot is not None and bot.api is not None:
+            await bot.process_update(update)
+            return
+        owner = await leases.owner(f"bot:{bot_id}")
+        if owner is None or owner == shard_router.worker_id:
+            logger.warning(f"Bot {bot_id} doesn't run, update dropped")
+            return
+        await shard_router.publish(
+            owner, {"action": BotCommand.UPDATE, "bot_id": bot_id, "update": update}
+        )
+
+    async def handle_or_publish(self, worker_id: str | None, command: dict):
+        if worker_id is None:
+            return
+        if worker_id == shard_router.worker_id:
+            await self.handle_bot_command(command)
+        else:
+            await shard_router.publish(worker_id, command)
 
     async def refresh_bots(self):
-        """Reload all bots"""
-        self.bots = []
-        await self.fetch_bots()
-        await self.start_bots()
+        """Reload all bots, only new, changed and removed bots are restarted"""
+        self.full_synced_at = 0
+        await self.sync_bots()
+
+    def request_shutdown(self):
+        """Signal handler, the first signal starts a graceful shutdown"""
+        if self.shutdown_task is None:
+            logger.info("Shutdown requested")
+            self.shutdown_task = asyncio.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """
+        Stop handling updates, send the queued replies for at most
+        SHUTDOWN_DRAIN_TIMEOUT seconds, then disconnect all bots in parallel and
+        leave the cluster so other workers take the bots over at once
+        """
+        started_at = time.monotonic()
+        # A rebalance in progress finishes first, later ones start no bots
+        async with self.rebalance_lock:
+            self.shutting_down = True
+        bots = [self, *self.bots]
+        for bot in bots:
+            bot.accepting_updates = False
+            if bot.client is not None and bot.client.is_connected():
+                # Updates stay with Telegram for the worker taking over
+                await bot.client.set_receive_updates(False)
+
+        # Broadcasts continue from their last checkpoint on another worker, and
+        # their unsent messages wait in the outbox for it
+        await task_manager.stop_task_group(TaskManager.BROADCASTS)
+        await task_manager.stop_task("outbox", TaskManager.SERVICES)
+
+        timeout = bot_settings.SHUTDOWN_DRAIN_TIMEOUT
+        if self.webhook_server is not None:
+            await self.webhook_server.drain(timeout)
+        rate_limiters = [bot.rate_limiter for bot in bots if bot.rate_limiter]
+        left = await asyncio.gather(
+            *(
+                rate_limiter.drain(max(0.0, timeout - (time.monotonic() - started_at)))
+                for rate_limiter in rate_limiters
+            )
+        )
+        if sum(left):
+            logger.warning(f"{sum(left)} queued messages were not sent before shutdown")
+
+        # Cancelled bots disconnect in their finally blocks, all at once
+        await task_manager.stop_task_group(TaskManager.BOTS)
+        await task_manager.stop_task_group(TaskManager.RATE_LIMITER)
+        # The cluster loop releases the leases once the bots are disconnected
+        await task_manager.stop_task(LeaseManager.WORKERS_KEY, TaskManager.SERVICES)
+        task_manager.stop()
+        logger.info(f"Shutdown finished in {time.monotonic() - started_at:.1f}s")
 
     async def start_main_bot(self):
+        self.started_at = time.monotonic()
         await self.backend.init_session()
         try:
+            self.synced_at = time.time()
             await self.fetch_bots()
+            self.full_synced_at = self.synced_at
         except Exception as e:
             logger.error(f"Error fetching bots: {str(e)}")
-        await self.start_bots()
+        self.timings["fetch_bots"] = time.monotonic() - self.started_at
+        try:
+            await self.start_bots()
+        finally:
+            await self.backend.close_session()
 
-    def get_bot_object(self, bot_id: str) -> "TelegramBot":
-        return next(bot for bot in self.bots if bot.bot_id == bot_id)
+    def get_bot_object(self, bot_id: str) -> "TelegramBot | None":
+        return self.bots.get(bot_id)
 
 
 @lru_cache
@@ -282,9 +725,24 @@ def get_main_bot() -> MainBot:
 
 class TelegramBot(Bot):
     """
-    Telegram bot class that handles all telegram bot operations
+    Telegram bot class that handles all telegram bot operations.
+
+    A bot receives updates over its own MTProto connection or, with the
+    webhook transport, from the worker's webhook server through the Bot API
     """
 
+    MTPROTO: str = "mtproto"
+    WEBHOOK: str = "webhook"
+
+    # Message patterns and the handlers they run, shared by both transports.
+    # Commands of the tenant loaded from the backend are routed before these
+    HANDLERS: list[tuple[str, str]] = [
+        ("/start", "start_handler"),
+        ("salom", "fetch_handler"),
+        ("token", "send_token"),
+        ("sleep", "sleep_handler"),
+    ]
+
     def __init__(
         self,
         bot_id: str,
@@ -292,40 +750,224 @@ class TelegramBot(Bot):
         bot_username: str,
         bot_owner: dict = None,
         is_running: bool = False,
+        transport: str = None,
     ):
+        self.transport: str = transport or bot_settings.BOT_TRANSPORT
         super().__init__(
             bot_id,
             bot_token,
             bot_username,
-            TelegramClient(
-                f"sessions/bot_session_{bot_id}_{bot_username}",
-                bot_settings.API_ID,
-                bot_settings.API_HASH,
+            (
+                RateLimitedClient(
+                    f"sessions/bot_session_{bot_id}_{bot_username}",
+                    bot_settings.API_ID,
+                    bot_settings.API_HASH,
+                    flood_sleep_threshold=bot_settings.FLOOD_SLEEP_THRESHOLD,
+                    # Deliver the updates received while the bot hibernated
+                    catch_up=True,
+                )
+                if self.transport == self.MTPROTO
+                else None
             ),
             bot_owner,
             is_running,
         )
+        self.api: BotApi | None = (
+            BotApi(bot_token) if self.transport == self.WEBHOOK else None
+        )
+        self.hibernating: bool = False
+        self.router: Router = self.get_router()
         self.setup_handlers()
 
+    async def send_message(self, chat_id: int, message: str, **kwargs):
+        if self.api is not None:
+            return await self.api.send_message(chat_id, message, **kwargs)
+        return await super().send_message(chat_id, message, **kwargs)
+
+    async def start(self):
+        """
+        Start the bot. After BOT_IDLE_TIMEOUT seconds without updates or sends
+        the bot disconnects and hibernates until it has outbound work or pending
+        updates, freeing the connection of bots that are rarely used
+        """
+        await self.backend.init_session()
+        await self.load_commands()
+        if self.transport == self.WEBHOOK:
+            return await self.start_webhook()
+        # A bot moved back from the webhook transport still has its webhook
+        await self.delete_webhook()
+        if not bot_settings.BOT_IDLE_TIMEOUT:
+            return await super().start()
+
+        try:
+            while True:
+                async with login_scheduler.slot(self.login_priority):
+                    await self.client.start(bot_token=self.bot_token)
+                self.hibernating = False
+                self.touch()
+                self.wake_up.clear()
+                self.ready.set()
+                logger.info(f"Bot {self.bot_id} is running...")
+                self.is_running = True
+                registry.set_running(self.bot_id, True)
+                try:
+                    if not await self.run_until_idle():
+                        return
+                finally:
+                    self.ready.clear()
+                    if self.client.is_connected():
+                        await self.client.disconnect()
+                await self.hibernate()
+        finally:
+            self.hibernating = False
+            self.is_running = False
+            registry.set_running(self.bot_id, False)
+
+    async def run_until_idle(self) -> bool:
+        """Return True once the bot is idle, False if it was disconnected"""
+        while True:
+            idle_for = time.monotonic() - self.last_activity
+            if idle_for >= bot_settings.BOT_IDLE_TIMEOUT:
+                return True
+            try:
+                await asyncio.wait_for(
+                    asyncio.shield(self.client.disconnected),
+                    bot_settings.BOT_IDLE_TIMEOUT - idle_for,
+                )
+                return False
+            except asyncio.TimeoutError:
+                continue
+
+    async def hibernate(self):
+        """Wait until the bot is woken up or has pending updates"""
+        self.hibernating = True
+        logger.info(f"{self} hibernates")
+        while not self.wake_up.is_set():
+            try:
+                await asyncio.wait_for(
+                    self.wake_up.wait(), bot_settings.BOT_WAKE_POLL_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                if await self.has_pending_updates():
+                    break
+        logger.info(f"{self} wakes up")
+
+    async def has_pending_updates(self) -> bool:
+        """
+        Peek at the Bot API update queue, updates are not confirmed without an
+        offset so the client still receives them when it catches up
+        """
+        response, status_code = await self.backend.fetch_data(
+            bot_settings.TELEGRAM_GET_ME + f"{self.bot_token}/getUpdates",
+            params={"limit": 1, "timeout": 0},
+            cache=False,
+        )
+        if status_code == 409:
+            # A webhook is set, the bot stays reachable until it is removed
+            return not await self.delete_webhook()
+        if status_code != 200:
+            return False
+        return bool(response.get("result"))
+
+    async def delete_webhook(self) -> bool:
+        """Remove the bot's webhook, getUpdates fails with 409 while it is set"""
+        try:
+            await (self.api or BotApi(self.bot_token)).delete_webhook()
+        except Exception as e:
+            logger.warning(f"{self} webhook not removed: {str(e)}")
+            return False
+        return True
+
+    async def start_webhook(self):
+        """Point the bot's webhook to the webhook server and wait for updates"""
+        await self.api.set_webhook(
+            WebhookServer.get_url(self.bot_id), bot_settings.WEBHOOK_SECRET
+        )
+        self.ready.set()
+        logger.info(f"Bot {self.bot_id} is receiving updates by webhook...")
+        self.is_running = True
+        registry.set_running(self.bot_id, True)
+        try:
+            await asyncio.Future()
+        finally:
+            self.ready.clear()
+            self.is_running = False
+            registry.set_running(self.bot_id, False)
+
+    def get_router(self, commands: list[dict] = None) -> Router:
+        """
+        Compile the tenant's commands and the built in handlers into a router.
+        A command is {"pattern": ..., "response": ...}, the pattern is a regex
+        """
+        return Router(
+            [
+                (command["pattern"], partial(self.reply_handler, command["response"]))
+                for command in commands or []
+                if command.get("pattern") and command.get("response")
+            ]
+            + [(pattern, getattr(self, handler)) for pattern, handler in self.HANDLERS]
+        )
+
+    async def load_commands(self):
+        """Load the tenant's command table, built in handlers stay on failure"""
+        commands, status_code = await self.backend.fetch_data(
+            bot_settings.BOT_COMMANDS_URL, params={"bot_id": self.bot_id}
+        )
+        if status_code != 200:
+            logger.warning(f"{self} commands not loaded, status {status_code}")
+            return
+        self.router = self.get_router(commands)
+        logger.info(f"{self} routes {len(self.router)} commands")
+
+    async def dispatch(self, event):
+        """Run the one handler the router resolves for the message"""
+        if not self.accepting_updates:
+            return
+        route = self.router.resolve(event.raw_text)
+        if route is None:
+            return
+        handler, event.pattern_match = route
+        # Tenant commands are partials of reply_handler
+        name = getattr(handler, "func", handler).__name__
+        with metrics.timer("handler_seconds", bot="tenant", handler=name):
+            await handler(event)
+
+    async def process_update(self, update: dict):
+        """Handle a Bot API message update like a Telethon NewMessage event"""
+        message = update.get("message")
+        self.updates += 1
+        if not message or "text" not in message:
+            return
+        self.touch()
+        await self.dispatch(WebhookEvent(self, message))
+
     def setup_handlers(self):
-        @self.client.on(events.NewMessage(pattern="/start"))
-        async def start_handler(event):
-            await event.respond("Welcome! Bot is running with async backend support.")
-
-        @self.client.on(events.NewMessage(pattern="salom"))
-        async def fetch_handler(event):
-            # Example of async backend request while handling telegram message
-            await event.respond("Salom qalaysan")
-
-        @self.client.on(events.NewMessage(pattern="token"))
-        async def send_token(event):
-            # Example of async backend request while handling telegram message
-            await event.respond(
-                f"Token: <code>{self.bot_token}</code>", parse_mode="html"
-            )
+        if self.client is None:
+            return
+
+        # Every update postpones hibernation
+        @self.client.on(events.Raw())
+        async def activity_handler(update):
+            self.updates += 1
+            self.touch()
+
+        self.client.add_event_handler(self.dispatch, events.NewMessage())
+
+    async def reply_handler(self, response: str, event):
+        await event.respond(response)
+
+    async def start_handler(self, event):
+        await event.respond("Welcome! Bot is running with async backend support.")
+
+    async def fetch_handler(self, event):
+        # Example of async backend request while handling telegram message
+        await event.respond("Salom qalaysan")
+
+    async def send_token(self, event):
+        # Example of async backend request while handling telegram message
+        await event.respond(f"Token: <code>{self.bot_token}</code>", parse_mode="html")
 
-        @self.client.on(events.NewMessage(pattern="sleep"))
-        async def sleep_handler(event):
-            await event.respond("Sleeping for 10 seconds...")
-            await asyncio.sleep(10)
-            await event.respond("Slept for 10 seconds")
+    async def sleep_handler(self, event):
+        await event.respond("Sleeping for 10 seconds...")
+        await asyncio.sleep(10)
+        await event.respond("Slept for 10 seconds")
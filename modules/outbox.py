@@ -0,0 +1,293 @@
+import asyncio
+import base64
+import logging
+import time
+from functools import lru_cache, partial
+from typing import Iterable
+
+from redis.exceptions import ResponseError
+from telethon import TelegramClient
+from telethon.errors import (
+    ChatWriteForbiddenError,
+    InputUserDeactivatedError,
+    PeerIdInvalidError,
+    UserIsBlockedError,
+)
+from telethon.extensions import BinaryReader
+from telethon.tl.types import TypeReplyMarkup
+
+from .rate_limiter import RateLimiter
+from .redis_connection import get_redis, RedisConnection
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+redis_client: RedisConnection = get_redis()
+
+logger = logging.getLogger(__name__)
+
+# Errors that mean the subscriber can't receive messages from the bot anymore
+BLOCKED_ERRORS = (
+    UserIsBlockedError,
+    InputUserDeactivatedError,
+    PeerIdInvalidError,
+    ChatWriteForbiddenError,
+)
+
+
+class OutboundMessage:
+    """
+    A message to send, described by data only so it can wait in redis and be
+    sent by whichever worker runs the bot. Buttons are kept as the serialized
+    reply markup, `progress_key` names a hash whose counters are updated with
+    the outcome
+    """
+
+    SENT: str = "sent"
+    FAILED: str = "failed"
+    BLOCKED: str = "blocked"
+
+    def __init__(
+        self,
+        bot_id: str,
+        chat_id: int,
+        text: str,
+        buttons=None,
+        parse_mode: str = None,
+        progress_key: str = None,
+    ):
+        self.bot_id: str = str(bot_id)
+        self.chat_id: int = chat_id
+        self.text: str = text
+        self.buttons: TypeReplyMarkup | None = TelegramClient.build_reply_markup(
+            buttons
+        )
+        self.parse_mode: str | None = parse_mode
+        self.progress_key: str | None = progress_key
+
+    def __repr__(self):
+        return f"OutboundMessage(bot_id={self.bot_id}, chat_id={self.chat_id})"
+
+    def to_fields(self) -> dict[str, str]:
+        fields = {
+            "bot_id": self.bot_id,
+            "chat_id": str(self.chat_id),
+            "text": self.text,
+        }
+        if self.buttons is not None:
+            fields["buttons"] = base64.b64encode(bytes(self.buttons)).decode()
+        if self.parse_mode:
+            fields["parse_mode"] = self.parse_mode
+        if self.progress_key:
+            fields["progress_key"] = self.progress_key
+        return fields
+
+    @classmethod
+    def from_fields(cls, fields: dict[bytes, bytes]) -> "OutboundMessage":
+        fields = {key.decode(): value.decode() for key, value in fields.items()}
+        buttons = fields.get("buttons")
+        return cls(
+            fields["bot_id"],
+            int(fields["chat_id"]),
+            fields["text"],
+            buttons=(
+                BinaryReader(base64.b64decode(buttons)).tgread_object()
+                if buttons
+                else None
+            ),
+            parse_mode=fields.get("parse_mode"),
+            progress_key=fields.get("progress_key"),
+        )
+
+    async def send(self, bot):
+        kwargs = {}
+        if self.parse_mode:
+            kwargs["parse_mode"] = self.parse_mode
+        if self.buttons is not None:
+            if bot.api is not None:
+                raise ValueError("Buttons can only be sent over MTProto")
+            kwargs["buttons"] = self.buttons
+        return await bot.send_message(self.chat_id, self.text, **kwargs)
+
+
+class Outbox:
+    """
+    Durable queue of outbound messages, one redis stream per bot read through
+    a consumer group.
+
+    The worker running a bot reads the bot's stream and sends the messages
+    through the bot's rate limiter in the bulk lane. An entry is deleted once
+    it is sent or has failed for good, so the stream length is the backlog.
+    Entries left unsent by a crashed or stopped worker stay pending in the
+    group and are claimed by the next worker running the bot
+    """
+
+    GROUP: str = "senders"
+
+    def __init__(self, consumer: str):
+        self.consumer: str = consumer
+        # Streams whose consumer group is known to exist
+        self.groups: set[str] = set()
+        # Entries being sent by this consumer, per bot id as a str like the
+        # bot ids of the entries
+        self.in_flight: dict[str, set[bytes]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.claimed_at: float = 0
+        # Counters
+        self.SENT: int = 0
+        self.FAILED: int = 0
+        self.BLOCKED: int = 0
+
+    def __repr__(self):
+        return f"Outbox(consumer={self.consumer}, in_flight={len(self.tasks)})"
+
+    @staticmethod
+    def get_key(bot_id) -> str:
+        return f"outbox:{bot_id}"
+
+    @classmethod
+    def queue(cls, pipe, messages: Iterable[OutboundMessage]):
+        """Add the messages to a pipeline, to queue them with other writes"""
+        for message in messages:
+            pipe.xadd(cls.get_key(message.bot_id), message.to_fields())
+
+    async def add(self, messages: Iterable[OutboundMessage]):
+        async with redis_client.pipeline(transaction=True) as pipe:
+            self.queue(pipe, messages)
+            await pipe.execute()
+
+    async def depth(self, bot_ids: list[str]) -> list[int]:
+        """Messages not sent yet, in flight included, of each bot"""
+        if not bot_ids:
+            return []
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for bot_id in bot_ids:
+                pipe.xlen(self.get_key(bot_id))
+            return await pipe.execute()
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.SENT,
+            "failed": self.FAILED,
+            "blocked": self.BLOCKED,
+            "in_flight": len(self.tasks),
+        }
+
+    async def create_groups(self, keys: Iterable[str]):
+        keys = [key for key in keys if key not in self.groups]
+        if not keys:
+            return
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xgroup_create(key, self.GROUP, id="0", mkstream=True)
+            results = await pipe.execute(raise_on_error=False)
+        for key, result in zip(keys, results):
+            # The group exists already
+            if isinstance(result, ResponseError) and "BUSYGROUP" not in str(result):
+                raise result
+            self.groups.add(key)
+
+    async def run(self, bots: Iterable):
+        """Send the queued messages of the bots, e.g. of the worker's registry"""
+        try:
+            while True:
+                local_bots = {str(bot.bot_id): bot for bot in bots}
+                if time.monotonic() - self.claimed_at > bot_settings.OUTBOX_CLAIM_IDLE:
+                    await self.claim(local_bots)
+                # Bots with a full batch in flight are read again once it shrinks
+                streams = {
+                    self.get_key(bot_id): ">"
+                    for bot_id in local_bots
+                    if len(self.in_flight.get(bot_id, ()))
+                    < bot_settings.OUTBOX_BATCH_SIZE
+                }
+                if not streams:
+                    await asyncio.sleep(bot_settings.OUTBOX_BLOCK)
+                    continue
+                await self.create_groups(streams)
+                try:
+                    response = await redis_client.xreadgroup(
+                        self.GROUP,
+                        self.consumer,
+                        streams,
+                        count=bot_settings.OUTBOX_BATCH_SIZE,
+                        block=int(bot_settings.OUTBOX_BLOCK * 1000),
+                    )
+                except ResponseError as e:
+                    # A stream was deleted with its group, create them again
+                    if "NOGROUP" not in str(e):
+                        raise
+                    self.groups.clear()
+                    continue
+                for key, entries in response or []:
+                    bot = local_bots[key.decode().removeprefix(self.get_key(""))]
+                    for entry_id, fields in entries:
+                        self.dispatch(bot, entry_id, fields)
+        finally:
+            # Unsent entries stay pending and are claimed later
+            for task in list(self.tasks):
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def claim(self, bots: dict):
+        """Take over the entries other consumers left unsent for too long"""
+        self.claimed_at = time.monotonic()
+        keys = [self.get_key(bot_id) for bot_id in bots]
+        await self.create_groups(keys)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.xautoclaim(
+                    key,
+                    self.GROUP,
+                    self.consumer,
+                    min_idle_time=int(bot_settings.OUTBOX_CLAIM_IDLE * 1000),
+                    count=bot_settings.OUTBOX_BATCH_SIZE,
+                )
+            results = await pipe.execute()
+        for bot_id, (_, entries, *_) in zip(bots, results):
+            for entry_id, fields in entries:
+                # Entries of this consumer waiting in the rate limiter are idle too
+                if entry_id not in self.in_flight.get(bot_id, ()):
+                    self.dispatch(bots[bot_id], entry_id, fields)
+
+    def dispatch(self, bot, entry_id: bytes, fields: dict):
+        self.in_flight.setdefault(str(bot.bot_id), set()).add(entry_id)
+        task = asyncio.create_task(self.process(bot, entry_id, fields))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def process(self, bot, entry_id: bytes, fields: dict):
+        # Read before parsing, so an entry that can't be parsed is counted too
+        progress_key = fields.get(b"progress_key", b"").decode() or None
+        try:
+            message = OutboundMessage.from_fields(fields)
+            await bot.connected()
+            await bot.rate_limiter.submit(
+                message.chat_id, partial(message.send, bot), RateLimiter.BULK
+            )
+            outcome = OutboundMessage.SENT
+            self.SENT += 1
+        except BLOCKED_ERRORS:
+            outcome = OutboundMessage.BLOCKED
+            self.BLOCKED += 1
+        except Exception as e:
+            logger.error(
+                f"Sending {entry_id.decode()} of bot {bot.bot_id} failed: {str(e)}"
+            )
+            outcome = OutboundMessage.FAILED
+            self.FAILED += 1
+        finally:
+            self.in_flight[str(bot.bot_id)].discard(entry_id)
+
+        key = self.get_key(bot.bot_id)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.xack(key, self.GROUP, entry_id)
+            pipe.xdel(key, entry_id)
+            if progress_key:
+                pipe.hincrby(progress_key, outcome, 1)
+                pipe.hincrby(progress_key, "queued", -1)
+            await pipe.execute()
+
+
+@lru_cache
+def get_outbox() -> Outbox:
+    return Outbox(bot_settings.WORKER_ID)
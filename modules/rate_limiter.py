@@ -1,75 +1,471 @@
 import asyncio
-from functools import lru_cache
 import logging
+import time
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from typing import Awaitable, Callable
+
+from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+from .metrics import get_metrics, Metrics
+from .task_manager import get_task_manager, TaskManager
 
 logger = logging.getLogger(__name__)
 
+# Flood sleep threshold of the requests sent from the limiter's workers, so their
+# flood waits reach the limiter. Other requests keep the client's threshold
+send_flood_sleep_threshold: ContextVar[int | None] = ContextVar(
+    "send_flood_sleep_threshold", default=None
+)
+
+# Define a global task manager
+task_manager: TaskManager = get_task_manager()
+
+# Define global metrics
+metrics: Metrics = get_metrics()
+
+
+class TokenBucket:
+    """
+    Token bucket that refills smoothly at `rate` tokens per second
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate: float = rate
+        self.capacity: int = capacity
+        self.tokens: float = capacity
+        self.updated_at: float = time.monotonic()
+        self.paused_until: float = 0
+
+    def __repr__(self):
+        return f"TokenBucket(rate={self.rate}, capacity={self.capacity}, tokens={self.tokens:.2f})"
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for `seconds` and restart from an empty bucket"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        # The bucket refills from the end of the pause, not during it
+        self.updated_at = self.paused_until
+
+    def try_acquire(self) -> float:
+        """Take a token, return 0 on success or seconds until the next token"""
+        if (paused := self.paused_until - time.monotonic()) > 0:
+            return paused
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    def release(self):
+        """Give back a token that was taken but not used"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class ChatBuckets:
+    """
+    Per-chat token buckets following Telegram limits, about 1 message per second
+    in a private chat and 20 messages per minute in a group. Buckets are kept in
+    LRU order and dropped once idle for `ttl` seconds or when over `max_size`
+    """
+
+    PRIVATE_RATE: float = 1.0
+    PRIVATE_BURST: int = 1
+    GROUP_RATE: float = 20 / 60
+    GROUP_BURST: int = 3
+
+    def __init__(self, ttl: float = 60, max_size: int = 10000):
+        self.ttl: float = ttl
+        self.max_size: int = max_size
+        self.buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, chat_id: int) -> TokenBucket:
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative in Telethon
+            bucket = (
+                TokenBucket(self.GROUP_RATE, self.GROUP_BURST)
+                if chat_id < 0
+                else TokenBucket(self.PRIVATE_RATE, self.PRIVATE_BURST)
+            )
+            self.buckets[chat_id] = bucket
+            self.evict()
+        else:
+            self.buckets.move_to_end(chat_id)
+        return bucket
+
+    def evict(self):
+        now = time.monotonic()
+        while self.buckets:
+            chat_id, bucket = next(iter(self.buckets.items()))
+            if (
+                len(self.buckets) <= self.max_size
+                and now - bucket.updated_at < self.ttl
+            ):
+                break
+            del self.buckets[chat_id]
+
+
+class RateLimitedClient(TelegramClient):
+    """
+    Telethon client whose requests sent by a rate limiter raise every flood
+    wait instead of sleeping through the short ones
+    """
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        if flood_sleep_threshold is None:
+            flood_sleep_threshold = send_flood_sleep_threshold.get()
+        return await super()._call(
+            sender,
+            request,
+            ordered=ordered,
+            flood_sleep_threshold=flood_sleep_threshold,
+        )
+
+
+class OutboundJob:
+    """
+    Queued outbound action, `action` is called only when the job is sent
+    """
+
+    def __init__(
+        self,
+        chat_id: int,
+        action: Callable[[], Awaitable],
+        future: asyncio.Future,
+        priority: str,
+    ):
+        self.chat_id: int = chat_id
+        self.action: Callable[[], Awaitable] = action
+        self.future: asyncio.Future = future
+        self.priority: str = priority
+        self.enqueued_at: float = time.monotonic()
+        self.retries: int = 0
+
+
+class Lane:
+    """
+    Queue of one priority class, pending jobs are grouped per chat and the chats
+    are served round-robin so a single noisy chat cannot starve the rest
+    """
+
+    def __init__(self, name: str, weight: int):
+        self.name: str = name
+        self.weight: int = weight
+        self.current: int = 0  # smooth weighted round-robin credit
+        self.chats: OrderedDict[int, deque[OutboundJob]] = OrderedDict()
+        self.pending: int = 0
+        self.has_room: asyncio.Event = asyncio.Event()
+        self.has_room.set()
+
+    def __len__(self):
+        return self.pending
+
+    def push(self, job: OutboundJob):
+        self.chats.setdefault(job.chat_id, deque()).append(job)
+        self.pending += 1
+
+    def push_front(self, job: OutboundJob):
+        """Put a job back at the head of its chat queue and serve that chat first"""
+        self.chats.setdefault(job.chat_id, deque()).appendleft(job)
+        self.chats.move_to_end(job.chat_id, last=False)
+        self.pending += 1
+
+    def pop_ready(
+        self, chat_buckets: ChatBuckets
+    ) -> tuple[OutboundJob | None, float | None]:
+        """
+        Pop the next job of the first chat, in round-robin order, whose bucket has
+        a token. Otherwise return the time until the earliest chat is ready
+        """
+        wait = None
+        for _ in range(len(self.chats)):
+            chat_id, jobs = next(iter(self.chats.items()))
+            self.chats.move_to_end(chat_id)
+            # Drop jobs whose senders gave up waiting, they don't need a token
+            while jobs and jobs[0].future.done():
+                jobs.popleft()
+                self.pending -= 1
+            if not jobs:
+                del self.chats[chat_id]
+                continue
+            chat_wait = chat_buckets.get(chat_id).try_acquire()
+            if chat_wait == 0:
+                job = jobs.popleft()
+                self.pending -= 1
+                if not jobs:
+                    del self.chats[chat_id]
+                return job, None
+            wait = chat_wait if wait is None else min(wait, chat_wait)
+        return None, wait
+
 
 class RateLimiter:
+    # Priority classes
+    INTERACTIVE: str = "interactive"
+    CALLBACK: str = "callback"
+    BULK: str = "bulk"
+
     def __init__(self, bot_id: str, bot_username: str):
         self.LIMIT: int = 25
         self.INTERVAL: int = 1000  # in milliseconds
-        self.QUEUE: list = []
-        self.SENT_MESSAGES: int = 0
+        self.WORKERS: int = 8
+        self.HIGH_WATER: int = 1000  # senders wait while the queue is this long
+        self.MAX_RETRIES: int = 5  # flood waits tolerated for a single job
+        # AIMD, the send rate halves on a flood wait and grows back per success
+        self.DECREASE_FACTOR: float = 0.5
+        self.INCREASE_STEP: float = 0.1  # messages per second
+        self.MIN_RATE: float = 1.0  # messages per second
+        # Priority lanes dequeued by weight, e.g. 8 interactive replies go out
+        # for every bulk message while both lanes have work
+        self.QUEUE: dict[str, Lane] = {
+            self.INTERACTIVE: Lane(self.INTERACTIVE, weight=8),
+            self.CALLBACK: Lane(self.CALLBACK, weight=4),
+            self.BULK: Lane(self.BULK, weight=1),
+        }
+        # Global budget of the bot and per-chat budgets under it
+        self.bucket: TokenBucket = TokenBucket(
+            rate=self.LIMIT * 1000 / self.INTERVAL, capacity=self.LIMIT
+        )
+        self.chat_buckets: ChatBuckets = ChatBuckets()
         self.bot_id: str = bot_id
         self.bot_username: str = bot_username
+        # Counters
         self.ALL_SENT_MESSAGES: int = 0
+        self.FLOOD_WAITS: int = 0
+        self.RETRIED_MESSAGES: int = 0
+        self.FAILED_MESSAGES: int = 0
+        # Seconds jobs waited in the queue before a worker took them, and jobs
+        self.WAIT_SECONDS: float = 0
+        self.WAITED_JOBS: int = 0
+        self.has_jobs: asyncio.Event = asyncio.Event()
+        self.sending: int = 0  # jobs taken by workers and not finished yet
 
     def __str__(self):
         return f"Rate limiter for bot @{self.bot_username}"
 
     def __repr__(self):
-        return f"RateLimiter(bot_id={self.bot_id}, bot_username={self.bot_username}, sent_messages={self.SENT_MESSAGES}, queue_length={len(self.QUEUE)})"
+        return f"RateLimiter(bot_id={self.bot_id}, bot_username={self.bot_username}, tokens={self.bucket.tokens:.2f}, queue_length={self.pending})"
 
     def __len__(self):
         """Return the length of the messages queue"""
-        return len(self.QUEUE)
+        return self.pending
+
+    @property
+    def pending(self) -> int:
+        return sum(len(lane) for lane in self.QUEUE.values())
 
     # Methods for messages
-    async def respond(self, event, *args, **kwargs):
-        rate_limiter = get_rate_limiter_from_memory(self.bot_id, self.bot_username)
-        if await rate_limiter.check_for_queue():
-            rate_limiter.SENT_MESSAGES += 1
-            rate_limiter.ALL_SENT_MESSAGES += 1
-            await event.respond(*args, **kwargs)
-        else:
-            await rate_limiter.add_to_queue(event.respond(*args, **kwargs))
-
-    async def delete(self, event, *args, **kwargs):
-        rate_limiter = get_rate_limiter_from_memory(self.bot_id, self.bot_username)
-        if await rate_limiter.check_for_queue():
-            rate_limiter.SENT_MESSAGES += 1
-            rate_limiter.ALL_SENT_MESSAGES += 1
-            await event.delete(*args, **kwargs)
-        else:
-            await rate_limiter.add_to_queue(event.delete(*args, **kwargs))
+    async def respond(self, event, *args, priority: str = INTERACTIVE, **kwargs):
+        return await self.submit(
+            event.chat_id, lambda: event.respond(*args, **kwargs), priority
+        )
+
+    async def delete(self, event, *args, priority: str = CALLBACK, **kwargs):
+        return await self.submit(
+            event.chat_id, lambda: event.delete(*args, **kwargs), priority
+        )
 
     # Methods for controlling queues
-    async def add_to_queue(self, task):
-        rate_limiter = get_rate_limiter_from_memory(self.bot_id, self.bot_username)
-        rate_limiter.QUEUE.append(task)
-
-    async def check_for_queue(self):
-        rate_limiter = get_rate_limiter_from_memory(self.bot_id, self.bot_username)
-        if rate_limiter.SENT_MESSAGES >= rate_limiter.LIMIT:
-            return False
-        else:
-            return True
+    async def submit(
+        self,
+        chat_id: int,
+        action: Callable[[], Awaitable],
+        priority: str = INTERACTIVE,
+    ):
+        """Queue an outbound action for a chat and wait until a worker has sent it"""
+        self.start()
+        lane = self.QUEUE[priority]
+        while lane.pending >= self.HIGH_WATER:
+            lane.has_room.clear()
+            await lane.has_room.wait()
+        future = asyncio.get_running_loop().create_future()
+        lane.push(OutboundJob(chat_id, action, future, priority))
+        self.has_jobs.set()
+        return await future
+
+    def cancel(self):
+        """Drop the queued jobs, their senders get a CancelledError"""
+        for lane in self.QUEUE.values():
+            for jobs in lane.chats.values():
+                for job in jobs:
+                    job.future.cancel()
+            lane.chats.clear()
+            lane.pending = 0
+            lane.has_room.set()
+
+    def requeue(self, job: OutboundJob):
+        """Put a job back at the head of its chat queue in its original lane"""
+        self.QUEUE[job.priority].push_front(job)
+        self.has_jobs.set()
+
+    @property
+    def max_rate(self) -> float:
+        return self.LIMIT * 1000 / self.INTERVAL
+
+    def set_rate(self, rate: float):
+        """Set the send rate, the burst allowed shrinks and grows with it"""
+        self.bucket.rate = rate
+        self.bucket.capacity = max(1, int(rate * self.INTERVAL / 1000))
+        self.bucket.tokens = min(self.bucket.tokens, self.bucket.capacity)
+
+    def on_success(self):
+        self.ALL_SENT_MESSAGES += 1
+        self.set_rate(min(self.max_rate, self.bucket.rate + self.INCREASE_STEP))
+
+    def on_flood_wait(self, seconds: int):
+        self.FLOOD_WAITS += 1
+        # Every worker sending in the flood window gets the flood wait, only
+        # the first one lowers the rate
+        if self.bucket.paused_until <= time.monotonic():
+            self.set_rate(max(self.MIN_RATE, self.bucket.rate * self.DECREASE_FACTOR))
+        self.bucket.pause(seconds)
+        logger.warning(
+            f"{self} hit a flood wait of {seconds}s, "
+            f"send rate is {self.bucket.rate:.2f}/s"
+        )
+
+    def stats(self) -> dict:
+        """Counters showing how close the bot runs to its ceiling"""
+        return {
+            "bot_id": self.bot_id,
+            "sent": self.ALL_SENT_MESSAGES,
+            "flood_waits": self.FLOOD_WAITS,
+            "retried": self.RETRIED_MESSAGES,
+            "failed": self.FAILED_MESSAGES,
+            "queue_length": self.pending,
+            "avg_wait": self.WAIT_SECONDS / self.WAITED_JOBS if self.WAITED_JOBS else 0,
+            "lanes": {name: len(lane) for name, lane in self.QUEUE.items()},
+            "rate": self.bucket.rate,
+            "max_rate": self.max_rate,
+            "utilization": self.bucket.rate / self.max_rate,
+            "paused_for": max(0.0, self.bucket.paused_until - time.monotonic()),
+        }
 
-    async def periodic_check(self):
-        rate_limiter = get_rate_limiter_from_memory(self.bot_id, self.bot_username)
+    def next_job(self) -> tuple[OutboundJob | None, float | None]:
+        """
+        Pick a lane by smooth weighted round-robin and pop its next ready job,
+        falling back to the other lanes while the chats of that lane are
+        throttled. Otherwise return the time until the earliest chat is ready
+        """
+        lanes = [lane for lane in self.QUEUE.values() if lane.pending]
+        total = sum(lane.weight for lane in lanes)
+        wait = None
+        for lane in sorted(
+            lanes, key=lambda lane: lane.current + lane.weight, reverse=True
+        ):
+            job, lane_wait = lane.pop_ready(self.chat_buckets)
+            if job is not None:
+                for other in lanes:
+                    other.current += other.weight
+                lane.current -= total
+                if not lane.pending:
+                    lane.current = 0
+                return job, None
+            if lane_wait is not None:
+                wait = lane_wait if wait is None else min(wait, lane_wait)
+        return None, wait
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Wait until every queued job is sent, at most `timeout` seconds. Return
+        the number of jobs left in the queue
+        """
+        deadline = time.monotonic() + timeout
+        while (self.pending or self.sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.pending
+
+    def start(self):
+        """Start the worker pool in the task manager if it is not running yet"""
+        if self.bot_id not in task_manager.tasks.get(TaskManager.RATE_LIMITER):
+            task_manager.add_task(self.bot_id, TaskManager.RATE_LIMITER, self.run)
+
+    async def run(self):
+        await asyncio.gather(*(self.worker() for _ in range(self.WORKERS)))
+
+    async def worker(self):
+        # Every worker runs in its own task, the threshold applies to its sends
+        send_flood_sleep_threshold.set(0)
         while True:
-            await asyncio.sleep(rate_limiter.INTERVAL / 1000)
-            rate_limiter.SENT_MESSAGES = 0
-            messages_task = rate_limiter.QUEUE[:rate_limiter.LIMIT]
-            rate_limiter.QUEUE = rate_limiter.QUEUE[rate_limiter.LIMIT:]
-            for message_task in messages_task:
-                await message_task
+            if not self.pending:
+                self.has_jobs.clear()
+                await self.has_jobs.wait()
+                continue
+            # Take the global token first so the job is picked by priority at
+            # the moment it can actually be sent
+            await self.bucket.acquire()
+            job, wait = self.next_job()
+            for lane in self.QUEUE.values():
+                if lane.pending < self.HIGH_WATER:
+                    lane.has_room.set()
+            if job is None:
+                # Sleep until a new job arrives or the earliest chat gets a token
+                self.bucket.release()
+                self.has_jobs.clear()
+                try:
+                    await asyncio.wait_for(self.has_jobs.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = time.monotonic() - job.enqueued_at
+            self.WAIT_SECONDS += wait
+            self.WAITED_JOBS += 1
+            metrics.observe("limiter_lane_wait_seconds", wait, lane=job.priority)
+            self.sending += 1
+            try:
+                result = await job.action()
+            except FloodWaitError as e:
+                self.on_flood_wait(e.seconds)
+                if job.retries < self.MAX_RETRIES:
+                    job.retries += 1
+                    self.RETRIED_MESSAGES += 1
+                    self.requeue(job)
+                elif not job.future.done():
+                    self.FAILED_MESSAGES += 1
+                    job.future.set_exception(e)
+            except Exception as e:
+                self.FAILED_MESSAGES += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.on_success()
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.sending -= 1
+
+
+# Rate limiters of the bots of this worker, by bot id as a str
+rate_limiters: dict[str, RateLimiter] = {}
 
 
-@lru_cache
 def get_rate_limiter_from_memory(bot_id: str, bot_username: str) -> RateLimiter:
     """
-    Get rate limiter from memory, every bot has own rate limiter instance in memory
+    Get rate limiter from memory, every bot has own rate limiter instance in memory.
+    It is keyed on the bot id alone, so every caller of a bot gets the same one
     """
-    return RateLimiter(bot_id, bot_username)
+    rate_limiter = rate_limiters.get(str(bot_id))
+    if rate_limiter is None:
+        rate_limiter = rate_limiters[str(bot_id)] = RateLimiter(bot_id, bot_username)
+    return rate_limiter
+
+
+def drop_rate_limiter(bot_id: str) -> RateLimiter | None:
+    """Forget the rate limiter of a bot that no longer runs on this worker"""
+    return rate_limiters.pop(str(bot_id), None)
@@ -1,17 +1,162 @@
 from functools import lru_cache
-from redis import Redis
 import json
 
+from redis import Redis
+from redis.asyncio import ConnectionPool, Redis as AsyncRedis
+from redis.asyncio.client import Pipeline
+
+from .metrics import get_metrics, Metrics
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+# Define global metrics
+metrics: Metrics = get_metrics()
+
+
+# Hash of running bots, bot id -> bot as JSON
+ACTIVE_BOTS_KEY = "bots:active"
+# Sorted set of bot ids by the number of updates they received
+BOT_ACTIVITY_KEY = "bots:activity"
+
+
+class TimedPipeline(Pipeline):
+    """
+    Pipeline whose round trips are recorded as one MULTI or PIPELINE command
+    """
+
+    async def execute(self, raise_on_error: bool = True):
+        with metrics.timer(
+            "redis_command_seconds",
+            command="MULTI" if self.is_transaction else "PIPELINE",
+        ):
+            return await super().execute(raise_on_error)
+
+
+class RedisConnection(AsyncRedis):
+    """
+    Asyncio redis client, all bots in the process share one connection pool.
+    The latency of every command and pipeline is recorded by command name
+    """
+
+    def __init__(self):
+        super().__init__(
+            connection_pool=ConnectionPool(
+                host=bot_settings.REDIS_HOST,
+                port=bot_settings.REDIS_PORT,
+                db=bot_settings.REDIS_DB,
+                max_connections=bot_settings.REDIS_MAX_CONNECTIONS,
+            )
+        )
+
+    async def execute_command(self, *args, **options):
+        with metrics.timer("redis_command_seconds", command=str(args[0]).upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str = None) -> Pipeline:
+        return TimedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+    async def set_active_bots(self, bots: list):
+        """Replace all running bots"""
+        async with self.pipeline(transaction=True) as pipe:
+            pipe.delete(ACTIVE_BOTS_KEY)
+            if bots:
+                pipe.hset(
+                    ACTIVE_BOTS_KEY,
+                    mapping={str(bot["id"]): json.dumps(bot) for bot in bots},
+                )
+            await pipe.execute()
+
+    async def get_active_bots(self) -> list[dict]:
+        return [json.loads(bot) for bot in await self.hvals(ACTIVE_BOTS_KEY)]
+
+    async def get_active_bot(self, bot_id: str) -> dict | None:
+        bot: bytes = await self.hget(ACTIVE_BOTS_KEY, str(bot_id))
+        return json.loads(bot) if bot else None
+
+    async def add_active_bot(self, bot: dict):
+        await self.hset(ACTIVE_BOTS_KEY, str(bot["id"]), json.dumps(bot))
+
+    async def remove_active_bot(self, bot_id: str):
+        await self.hdel(ACTIVE_BOTS_KEY, str(bot_id))
+
+    async def update_active_bots(self, started: list[dict], stopped: list[str]):
+        """Add and remove running bots in one round trip"""
+        async with self.pipeline(transaction=True) as pipe:
+            if started:
+                pipe.hset(
+                    ACTIVE_BOTS_KEY,
+                    mapping={str(bot["id"]): json.dumps(bot) for bot in started},
+                )
+            if stopped:
+                pipe.hdel(ACTIVE_BOTS_KEY, *(str(bot_id) for bot_id in stopped))
+            await pipe.execute()
+
+    async def add_bot_activity(self, updates: dict[str, int]):
+        async with self.pipeline(transaction=False) as pipe:
+            for bot_id, count in updates.items():
+                pipe.zincrby(BOT_ACTIVITY_KEY, count, str(bot_id))
+            await pipe.execute()
+
+    async def get_bot_activity(self, bot_ids: list[str]) -> list[float]:
+        """Updates received by each bot, 0 for bots without updates"""
+        if not bot_ids:
+            return []
+        scores = await self.zmscore(
+            BOT_ACTIVITY_KEY, [str(bot_id) for bot_id in bot_ids]
+        )
+        return [score or 0 for score in scores]
+
+    async def set_as_json(self, key: str, value: dict | list, expire: int = None):
+        await self.set(key, json.dumps(value), ex=expire)
+
+    async def get_as_json(self, key: str) -> dict | list:
+        data: bytes = await self.get(key)
+        return json.loads(data.decode("utf-8")) if data else None
+
+    async def set_many_as_json(self, items: dict[str, dict | list], expire: int = None):
+        """Set several keys in one round trip"""
+        async with self.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(key, json.dumps(value), ex=expire)
+            await pipe.execute()
+
+    async def get_many_as_json(self, keys: list[str]) -> list[dict | list | None]:
+        """Get several keys in one round trip, missing keys are None"""
+        if not keys:
+            return []
+        return [
+            json.loads(data.decode("utf-8")) if data else None
+            for data in await self.mget(keys)
+        ]
+
+
+class SyncRedisConnection(Redis):
+    """
+    Blocking redis client for scripts that run outside the event loop
+    """
 
-class RedisConnection(Redis):
     def __init__(self):
-        super().__init__(host="localhost", port=6379, db=0)
+        super().__init__(
+            host=bot_settings.REDIS_HOST,
+            port=bot_settings.REDIS_PORT,
+            db=bot_settings.REDIS_DB,
+        )
 
     def set_active_bots(self, bots: list):
-        self.set_as_json("active_bots", bots)
+        with self.pipeline(transaction=True) as pipe:
+            pipe.delete(ACTIVE_BOTS_KEY)
+            if bots:
+                pipe.hset(
+                    ACTIVE_BOTS_KEY,
+                    mapping={str(bot["id"]): json.dumps(bot) for bot in bots},
+                )
+            pipe.execute()
 
     def get_active_bots(self) -> list[dict]:
-        return self.get_as_json("active_bots")
+        return [json.loads(bot) for bot in self.hvals(ACTIVE_BOTS_KEY)]
 
     def set_as_json(self, key: str, value: dict | list, expire: int = None):
         self.set(key, json.dumps(value), ex=expire)
@@ -20,7 +165,26 @@ class RedisConnection(Redis):
         data: bytes = self.get(key)
         return json.loads(data.decode("utf-8")) if data else None
 
+    def set_many_as_json(self, items: dict[str, dict | list], expire: int = None):
+        with self.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(key, json.dumps(value), ex=expire)
+            pipe.execute()
+
+    def get_many_as_json(self, keys: list[str]) -> list[dict | list | None]:
+        if not keys:
+            return []
+        return [
+            json.loads(data.decode("utf-8")) if data else None
+            for data in self.mget(keys)
+        ]
+
 
 @lru_cache
-def get_redis():
+def get_redis() -> RedisConnection:
     return RedisConnection()
+
+
+@lru_cache
+def get_sync_redis() -> SyncRedisConnection:
+    return SyncRedisConnection()
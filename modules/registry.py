@@ -0,0 +1,89 @@
+import logging
+from functools import lru_cache
+from typing import Iterator
+
+logger = logging.getLogger(__name__)
+
+
+class BotRegistry:
+    """
+    Bots hosted by this worker, indexed by id, by owner and by running state.
+
+    Ids are normalized to str, the backend and callback data mix int and str
+    ids. Every method runs without awaiting, so the indexes are updated
+    atomically for the event loop.
+    """
+
+    def __init__(self):
+        self.bots: dict[str, object] = {}
+        self.owners: dict[str, set[str]] = {}
+        self.running: set[str] = set()
+
+    def __len__(self):
+        return len(self.bots)
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self.bots.values()))
+
+    def __contains__(self, bot_id):
+        return str(bot_id) in self.bots
+
+    def __repr__(self):
+        return f"BotRegistry(bots={len(self.bots)}, running={len(self.running)})"
+
+    @staticmethod
+    def get_owner_id(bot) -> str | None:
+        """The backend sends the owner either as an id or as an account dict"""
+        owner = bot.bot_owner
+        if isinstance(owner, dict):
+            owner = owner.get("id")
+        return None if owner is None else str(owner)
+
+    def get(self, bot_id):
+        return self.bots.get(str(bot_id))
+
+    def add(self, bot) -> bool:
+        """Register a bot, return False if a bot with the same id exists"""
+        bot_id = str(bot.bot_id)
+        if bot_id in self.bots:
+            return False
+        self.bots[bot_id] = bot
+        owner_id = self.get_owner_id(bot)
+        if owner_id is not None:
+            self.owners.setdefault(owner_id, set()).add(bot_id)
+        return True
+
+    def remove(self, bot_id):
+        """Unregister a bot and return it, None if it isn't registered"""
+        bot_id = str(bot_id)
+        bot = self.bots.pop(bot_id, None)
+        if bot is None:
+            return None
+        self.running.discard(bot_id)
+        owner_id = self.get_owner_id(bot)
+        owned = self.owners.get(owner_id)
+        if owned is not None:
+            owned.discard(bot_id)
+            if not owned:
+                del self.owners[owner_id]
+        return bot
+
+    def set_running(self, bot_id, is_running: bool):
+        bot_id = str(bot_id)
+        if bot_id not in self.bots:
+            return
+        if is_running:
+            self.running.add(bot_id)
+        else:
+            self.running.discard(bot_id)
+
+    def by_owner(self, owner_id) -> list:
+        return [self.bots[bot_id] for bot_id in self.owners.get(str(owner_id), ())]
+
+    def get_running(self) -> list:
+        return [self.bots[bot_id] for bot_id in self.running]
+
+
+@lru_cache
+def get_bot_registry() -> BotRegistry:
+    return BotRegistry()
@@ -0,0 +1,104 @@
+import logging
+import re
+from typing import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[..., Awaitable]
+
+# Characters that make a pattern a regex rather than a literal text
+REGEX_CHARS = set(".^$*+?{}[]\\|()")
+
+# Group numbers shift in a combined regex, so patterns referring to groups by
+# number, with backreferences or conditionals, are matched alone
+NUMBERED_REFERENCE = re.compile(r"\\[1-9]|\(\?\(\d")
+
+
+class Router:
+    """
+    Resolves a message to one handler. Routes are compiled once into a dict
+    of literal texts and, usually, a single regex of all patterns, so a
+    message costs one dict lookup and one regex match however many routes
+    exist.
+
+    Patterns are matched from the start of the text like Telethon's
+    NewMessage(pattern=...) and the first matching route wins. A literal route
+    equal to the whole text wins over the regex routes after it
+    """
+
+    def __init__(self, routes: list[tuple[str, Handler]]):
+        self.routes: list[tuple[str, Handler]] = []
+        self.patterns: list[re.Pattern] = []
+        for pattern, handler in routes:
+            try:
+                self.patterns.append(re.compile(pattern))
+            except re.error as e:
+                logger.warning(f"Skipping invalid route pattern {pattern!r}: {e}")
+                continue
+            self.routes.append((pattern, handler))
+        # Literal texts and the index of their first route
+        self.exact: dict[str, int] = {}
+        for index, (pattern, _) in enumerate(self.routes):
+            if not REGEX_CHARS.intersection(pattern):
+                self.exact.setdefault(pattern, index)
+        self.handlers: list[Handler] = [handler for _, handler in self.routes]
+        # Consecutive routes are compiled into one regex each, in order. A
+        # pattern that can't be part of a combined regex, e.g. with global
+        # flags, a backreference or a group name of an earlier route, starts
+        # the next regex, or is matched alone if it can't even be wrapped
+        self.regexes: list[tuple[re.Pattern, int | None]] = []
+        sources: list[str] = []
+        for index, (pattern, _) in enumerate(self.routes):
+            source = f"(?P<route{index}>{pattern})"
+            if NUMBERED_REFERENCE.search(pattern):
+                self.add_regex(sources)
+                sources = []
+                self.regexes.append((self.patterns[index], index))
+                continue
+            if sources and self.compile([*sources, source]) is not None:
+                sources.append(source)
+                continue
+            self.add_regex(sources)
+            sources = []
+            if self.compile([source]) is not None:
+                sources.append(source)
+            else:
+                self.regexes.append((self.patterns[index], index))
+        self.add_regex(sources)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __repr__(self):
+        return (
+            f"Router(routes={len(self.routes)}, exact={len(self.exact)}, "
+            f"regexes={len(self.regexes)})"
+        )
+
+    @staticmethod
+    def compile(sources: list[str]) -> re.Pattern | None:
+        try:
+            return re.compile("|".join(sources))
+        except re.error:
+            return None
+
+    def add_regex(self, sources: list[str]):
+        """Add a combined regex, its matching route is told by the group name"""
+        if sources:
+            self.regexes.append((self.compile(sources), None))
+
+    def resolve(self, text: str) -> tuple[Handler, re.Match | None] | None:
+        """Return the handler for the text and the regex match, if any"""
+        exact = self.exact.get(text)
+        for regex, index in self.regexes:
+            match = regex.match(text)
+            if match is None:
+                continue
+            if index is None:
+                index = int(match.lastgroup.removeprefix("route"))
+            # No route before the literal one matches the text
+            if exact is not None and exact <= index:
+                return self.handlers[exact], None
+            # Match the route's own pattern again, so handlers see its groups
+            return self.handlers[index], self.patterns[index].match(text)
+        return None
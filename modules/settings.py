@@ -1,7 +1,9 @@
+import hashlib
 from functools import lru_cache
 from pathlib import Path
 from dotenv import load_dotenv
 import os
+import socket
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -18,17 +20,119 @@ class Settings:
         self.MAIN_BOT_TOKEN = os.getenv("MAIN_BOT_TOKEN")
         self.MAIN_BOT_USERNAME = os.getenv("MAIN_BOT_USERNAME")
 
+        # Flood waits up to this many seconds are slept inside Telethon, e.g.
+        # during logins. Sends of the rate limiter get every flood wait
+        self.FLOOD_SLEEP_THRESHOLD = int(os.getenv("FLOOD_SLEEP_THRESHOLD", 60))
+
+        # Sharding, SHARD_COUNT > 1 runs a supervisor with that many worker
+        # processes and every worker gets its own SHARD_ID
+        self.SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+        self.SHARD_ID = int(os.getenv("SHARD_ID")) if os.getenv("SHARD_ID") else None
+
+        # Cluster, every worker process of every node owns bots through redis
+        # leases that expire LEASE_TTL seconds after its last heartbeat
+        self.NODE_ID = os.getenv("NODE_ID", socket.gethostname())
+        self.WORKER_ID = f"{self.NODE_ID}:{self.SHARD_ID or 0}"
+        self.LEASE_TTL = int(os.getenv("LEASE_TTL", 10))
+        self.HEARTBEAT_INTERVAL = int(os.getenv("HEARTBEAT_INTERVAL", 3))
+
+        # Bot reconciliation, bots changed in the backend are polled every
+        # BOTS_SYNC_INTERVAL seconds and the whole list every BOTS_FULL_SYNC_INTERVAL
+        self.BOTS_SYNC_INTERVAL = int(os.getenv("BOTS_SYNC_INTERVAL", 30))
+        self.BOTS_FULL_SYNC_INTERVAL = int(os.getenv("BOTS_FULL_SYNC_INTERVAL", 600))
+
+        # Cold start, at most LOGIN_CONCURRENCY bot logins run at once and they
+        # start about LOGIN_INTERVAL seconds apart
+        self.LOGIN_CONCURRENCY = int(os.getenv("LOGIN_CONCURRENCY", 10))
+        self.LOGIN_INTERVAL = float(os.getenv("LOGIN_INTERVAL", 0.2))
+        # The cold start report waits at most this long for bots to come online
+        self.STARTUP_REPORT_TIMEOUT = int(os.getenv("STARTUP_REPORT_TIMEOUT", 600))
+
+        # Hibernation, tenant bots without updates or sends for BOT_IDLE_TIMEOUT
+        # seconds disconnect and poll getUpdates every BOT_WAKE_POLL_INTERVAL
+        # seconds until they have work again. 0 keeps every bot connected
+        self.BOT_IDLE_TIMEOUT = int(os.getenv("BOT_IDLE_TIMEOUT", 600))
+        self.BOT_WAKE_POLL_INTERVAL = int(os.getenv("BOT_WAKE_POLL_INTERVAL", 30))
+
+        # Update ingestion of tenant bots, "mtproto" keeps a Telethon connection
+        # per bot, "webhook" receives Bot API updates for all bots on one server.
+        # Webhook bots need WEBHOOK_URL, the public url of the webhook server
+        self.BOT_TRANSPORT = os.getenv("BOT_TRANSPORT", "mtproto")
+        self.WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+        self.WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+        self.WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+        # Sent back by Telegram with every update, defaults to a value derived
+        # from the main bot token so all workers agree on it
+        self.WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(
+            f"webhook:{self.MAIN_BOT_TOKEN}".encode()
+        ).hexdigest()
+
+        # User states expire after STATE_TTL seconds without changes, 0 keeps them
+        self.STATE_TTL = int(os.getenv("STATE_TTL", 86400))
+
+        # In-process cache of user states in front of redis
+        self.STATE_CACHE_TTL = int(os.getenv("STATE_CACHE_TTL", 60))
+        self.STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", 10000))
+
+        # Graceful shutdown, queued replies are sent for at most this many
+        # seconds after SIGTERM before the bots disconnect
+        self.SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", 8))
+
+        # Prometheus metrics, served on METRICS_PORT plus the shard id, 0
+        # disables them
+        self.METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+        self.METRICS_PORT = int(os.getenv("METRICS_PORT", 9200))
+
+        # Redis
+        self.REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+        self.REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+        self.REDIS_DB = int(os.getenv("REDIS_DB", 0))
+        self.REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+
+        # Shared HTTP connection pool
+        self.BACKEND_POOL_LIMIT = int(os.getenv("BACKEND_POOL_LIMIT", 100))
+        self.BACKEND_HOST_CONCURRENCY = int(os.getenv("BACKEND_HOST_CONCURRENCY", 30))
+        self.BACKEND_KEEPALIVE_TIMEOUT = int(os.getenv("BACKEND_KEEPALIVE_TIMEOUT", 30))
+        self.BACKEND_DNS_CACHE_TTL = int(os.getenv("BACKEND_DNS_CACHE_TTL", 300))
+
+        # Backend resilience
+        self.BACKEND_TIMEOUT = float(os.getenv("BACKEND_TIMEOUT", 10))
+        self.BACKEND_RETRIES = int(os.getenv("BACKEND_RETRIES", 2))
+        self.BACKEND_RETRY_BACKOFF = float(os.getenv("BACKEND_RETRY_BACKOFF", 0.2))
+        self.CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", 30))
+
         # URLs
         # API Endpoint
         self.API_ENDPOINT = f"{self.BACKEND_URL}/api/v1/"
 
+        # Telegram Bot API, can point to a local stand-in of the Bot API
+        self.TELEGRAM_API_URL = os.getenv(
+            "TELEGRAM_API_URL", "https://api.telegram.org"
+        ).rstrip("/")
+
         # Telegram getMe url
-        self.TELEGRAM_GET_ME = "https://api.telegram.org/bot"
+        self.TELEGRAM_GET_ME = f"{self.TELEGRAM_API_URL}/bot"
 
         # Bot URLs
         self.BOTS_URL = f"{self.API_ENDPOINT}bots/"
         self.BOT_ADD_URL = f"{self.API_ENDPOINT}bot/add/"
         self.BOT_UPDATE_URL = f"{self.API_ENDPOINT}bot/update/"
+        self.SUBSCRIBERS_URL = f"{self.API_ENDPOINT}bot/subscribers/"
+        self.BOT_COMMANDS_URL = f"{self.API_ENDPOINT}bot/commands/"
+
+        # Broadcast
+        self.BROADCAST_PAGE_SIZE = int(os.getenv("BROADCAST_PAGE_SIZE", 1000))
+        # A broadcast fails when none of its queued messages was sent for this
+        # many seconds
+        self.BROADCAST_STALL_TIMEOUT = float(os.getenv("BROADCAST_STALL_TIMEOUT", 300))
+
+        # Outbox, messages read from a bot's stream at once, seconds a read
+        # waits for new messages and seconds an unsent message stays with a
+        # worker before another one claims it
+        self.OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+        self.OUTBOX_BLOCK = float(os.getenv("OUTBOX_BLOCK", 2))
+        self.OUTBOX_CLAIM_IDLE = float(os.getenv("OUTBOX_CLAIM_IDLE", 60))
 
         # Account URLs
         self.ACCOUNT_ADD_URL = f"{self.API_ENDPOINT}account/add/"
@@ -37,6 +141,14 @@ class Settings:
         self.CHANNELS_URL = f"{self.API_ENDPOINT}channels/"
         self.CHANNEL_ADD_URL = f"{self.API_ENDPOINT}channel/add/"
 
+        # Seconds a GET response of an endpoint is cached, other endpoints
+        # are not cached
+        self.CACHE_TTLS = {
+            self.BOTS_URL: int(os.getenv("BOTS_CACHE_TTL", 60)),
+            self.CHANNELS_URL: int(os.getenv("CHANNELS_CACHE_TTL", 300)),
+            self.BOT_COMMANDS_URL: int(os.getenv("BOT_COMMANDS_CACHE_TTL", 300)),
+        }
+
 
 @lru_cache
 def get_settings() -> Settings:
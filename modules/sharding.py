@@ -0,0 +1,164 @@
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+from functools import lru_cache
+from multiprocessing.connection import wait
+from typing import Awaitable, Callable
+
+from .redis_connection import get_redis, RedisConnection
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+redis_client: RedisConnection = get_redis()
+
+logger = logging.getLogger(__name__)
+
+
+class BotCommand:
+    """
+    Actions sent to the worker that owns a bot
+    """
+
+    START = "start"
+    STOP = "stop"
+    BROADCAST = "broadcast"
+    NOTIFY = "notify"
+    REBALANCE = "rebalance"
+    UPDATE = "update"
+
+
+class HashRing:
+    """
+    Consistent hash ring, adding or removing a member only moves the keys that
+    belong to that member
+    """
+
+    def __init__(self, members: list[str], replicas: int = 100):
+        self.members: list[str] = list(members)
+        self.ring: list[tuple[int, str]] = sorted(
+            (self.hash(f"{member}:{replica}"), member)
+            for member in self.members
+            for replica in range(replicas)
+        )
+        self.hashes: list[int] = [point for point, _ in self.ring]
+
+    def __len__(self):
+        return len(self.members)
+
+    @staticmethod
+    def hash(key: str) -> int:
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+    def get(self, key: str) -> str | None:
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.hashes, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardRouter:
+    """
+    Maps bots to workers with a consistent hash ring over the live workers of
+    the cluster and delivers bot commands to a worker through redis pub/sub.
+    The main bot is placed on the ring like any other bot under MAIN_BOT_KEY
+    """
+
+    MAIN_BOT_KEY: str = "main"
+    ALL_WORKERS_CHANNEL: str = "workers:commands"
+
+    def __init__(self, worker_id: str):
+        self.worker_id: str = worker_id
+        self.ring: HashRing = HashRing([worker_id])
+
+    def __repr__(self):
+        return f"ShardRouter(worker_id={self.worker_id}, workers={len(self.ring)})"
+
+    def set_members(self, workers: list[str]):
+        if sorted(workers) != sorted(self.ring.members):
+            logger.info(f"Cluster workers changed: {sorted(workers)}")
+            self.ring = HashRing(workers)
+
+    @staticmethod
+    def get_channel(worker_id: str) -> str:
+        return f"worker:{worker_id}:commands"
+
+    def owner_of(self, key) -> str:
+        return self.ring.get(str(key))
+
+    def owns(self, key) -> bool:
+        return self.owner_of(key) == self.worker_id
+
+    async def publish(self, worker_id: str, command: dict):
+        await redis_client.publish(self.get_channel(worker_id), json.dumps(command))
+
+    async def publish_all(self, command: dict):
+        await redis_client.publish(self.ALL_WORKERS_CHANNEL, json.dumps(command))
+
+    async def listen(self, callback: Callable[[dict], Awaitable]):
+        """Run `callback` for every command sent to this worker or to all workers"""
+        async with redis_client.pubsub() as pubsub:
+            await pubsub.subscribe(
+                self.get_channel(self.worker_id), self.ALL_WORKERS_CHANNEL
+            )
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                try:
+                    await callback(json.loads(message["data"]))
+                except Exception as e:
+                    logger.error(f"Error handling shard command: {str(e)}")
+
+
+@lru_cache
+def get_shard_router() -> ShardRouter:
+    return ShardRouter(bot_settings.WORKER_ID)
+
+
+def run_supervisor(shard_count: int, target: Callable[[], None]):
+    """
+    Run `target` in `shard_count` worker processes, each with its own event loop
+    and SHARD_ID, and restart workers that die
+    """
+    context = multiprocessing.get_context("spawn")
+    workers: dict[int, multiprocessing.Process] = {}
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    # Pass SIGTERM on to the workers, which shut down gracefully
+    signal.signal(signal.SIGTERM, stop)
+
+    def spawn(shard_id: int):
+        # Spawned processes read their settings from the inherited environment
+        os.environ["SHARD_ID"] = str(shard_id)
+        process = context.Process(target=target, name=f"shard-{shard_id}")
+        process.start()
+        workers[shard_id] = process
+        logger.info(f"Started shard {shard_id} with pid {process.pid}")
+
+    for shard_id in range(shard_count):
+        spawn(shard_id)
+    os.environ.pop("SHARD_ID")
+
+    try:
+        while True:
+            wait([process.sentinel for process in workers.values()])
+            for shard_id, process in list(workers.items()):
+                if process.is_alive():
+                    continue
+                logger.error(
+                    f"Shard {shard_id} exited with code {process.exitcode}, restarting"
+                )
+                time.sleep(1)
+                spawn(shard_id)
+            os.environ.pop("SHARD_ID", None)
+    finally:
+        for process in workers.values():
+            process.terminate()
+        for process in workers.values():
+            process.join()
@@ -0,0 +1,110 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import statistics
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+logger = logging.getLogger(__name__)
+
+
+class LoginScheduler:
+    """
+    Bounds the bot logins in flight and paces their starts with jitter, so a
+    cold start of hundreds of bots doesn't hit Telegram's login flood limits.
+    Waiting logins are served by priority, lower first, then in arrival order
+    """
+
+    def __init__(self, concurrency: int, interval: float):
+        self.concurrency: int = concurrency
+        self.interval: float = interval
+        self.in_flight: int = 0
+        self.waiters: list[tuple[float, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+        self.next_start_at: float = 0
+        # Seconds spent waiting for a slot and logging in, of recent logins
+        self.wait_times: deque[float] = deque(maxlen=10000)
+        self.login_times: deque[float] = deque(maxlen=10000)
+        self.failures: int = 0
+
+    def __repr__(self):
+        return f"LoginScheduler(in_flight={self.in_flight}, queued={len(self.waiters)})"
+
+    def wake(self):
+        while self.waiters and self.in_flight < self.concurrency:
+            *_, future = heapq.heappop(self.waiters)
+            if future.done():
+                continue
+            self.in_flight += 1
+            future.set_result(None)
+
+    def release(self):
+        self.in_flight -= 1
+        self.wake()
+
+    async def acquire(self, priority: float):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        self.wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot was granted while the waiter got cancelled
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        # Pace login starts, the jitter keeps workers from starting in lockstep
+        now = time.monotonic()
+        start_at = max(now, self.next_start_at)
+        self.next_start_at = start_at + self.interval * random.uniform(0.5, 1.5)
+        try:
+            await asyncio.sleep(start_at - now)
+        except asyncio.CancelledError:
+            self.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, priority: float = 0):
+        """Hold one login slot while the body runs"""
+        queued_at = time.monotonic()
+        await self.acquire(priority)
+        started_at = time.monotonic()
+        try:
+            yield
+        except Exception:
+            self.failures += 1
+            raise
+        else:
+            self.login_times.append(time.monotonic() - started_at)
+        finally:
+            self.wait_times.append(started_at - queued_at)
+            self.release()
+
+    def stats(self) -> dict:
+        def summary(values: deque[float]) -> dict:
+            if not values:
+                return {}
+            return {
+                "avg": round(statistics.fmean(values), 2),
+                "max": round(max(values), 2),
+            }
+
+        return {
+            "logins": len(self.login_times),
+            "failures": self.failures,
+            "wait": summary(self.wait_times),
+            "login": summary(self.login_times),
+        }
+
+
+@lru_cache
+def get_login_scheduler() -> LoginScheduler:
+    return LoginScheduler(bot_settings.LOGIN_CONCURRENCY, bot_settings.LOGIN_INTERVAL)
@@ -0,0 +1,105 @@
+"""
+Scan user state keys and compact them:
+
+- legacy JSON states under `user:{id}:state` are moved to `state:{id}` hashes
+- states in the NOTHING state are deleted, a missing key means NOTHING
+- states without an expiry get STATE_TTL
+
+Run it once after deploying the hash encoding and whenever STATE_TTL changes:
+
+    python -m modules.state_compaction [--dry-run]
+"""
+
+import argparse
+import json
+import logging
+from collections import Counter
+
+from .redis_connection import get_sync_redis, SyncRedisConnection
+from .settings import get_settings, Settings
+from .state_manager import MainBotStates, StateManager, STATE_FIELD
+
+bot_settings: Settings = get_settings()
+
+logger = logging.getLogger(__name__)
+
+LEGACY_PATTERN = "user:*:state"
+BATCH_SIZE = 500
+
+
+def batches(client: SyncRedisConnection, pattern: str):
+    batch = []
+    for key in client.scan_iter(match=pattern, count=BATCH_SIZE):
+        batch.append(key)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def migrate_legacy(client: SyncRedisConnection, stats: Counter, dry_run: bool):
+    for keys in batches(client, LEGACY_PATTERN):
+        values = client.mget(keys)
+        with client.pipeline(transaction=False) as pipe:
+            for key, value in zip(keys, values):
+                if value is None:
+                    continue
+                try:
+                    legacy = json.loads(value)
+                except ValueError:
+                    legacy = {}
+                user_id = key.decode().split(":")[1]
+                state = legacy.get("state") or MainBotStates.NOTHING
+                data = legacy.get("data") or {}
+                if state == MainBotStates.NOTHING and not data:
+                    stats["legacy_dropped"] += 1
+                else:
+                    StateManager.write(pipe, StateManager.get_key(user_id), state, data)
+                    stats["legacy_migrated"] += 1
+                pipe.delete(key)
+            if not dry_run:
+                pipe.execute()
+
+
+def compact(client: SyncRedisConnection, stats: Counter, dry_run: bool):
+    for keys in batches(client, StateManager.get_key("*")):
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hget(key, STATE_FIELD)
+                pipe.ttl(key)
+            results = pipe.execute()
+        with client.pipeline(transaction=False) as pipe:
+            for key, state, ttl in zip(keys, results[::2], results[1::2]):
+                stats["states"] += 1
+                if state is None or state.decode() == MainBotStates.NOTHING:
+                    pipe.delete(key)
+                    stats["deleted"] += 1
+                elif ttl == -1 and bot_settings.STATE_TTL:
+                    pipe.expire(key, bot_settings.STATE_TTL)
+                    stats["expiry_set"] += 1
+            if not dry_run:
+                pipe.execute()
+
+
+def compact_states(dry_run: bool = False) -> Counter:
+    client: SyncRedisConnection = get_sync_redis()
+    stats = Counter()
+    migrate_legacy(client, stats, dry_run)
+    compact(client, stats, dry_run)
+    return stats
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    parser = argparse.ArgumentParser(description="Compact user state keys")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count what would change"
+    )
+    args = parser.parse_args()
+    result = compact_states(dry_run=args.dry_run)
+    mode = "dry run" if args.dry_run else "run"
+    logger.info(f"State compaction {mode} finished: {dict(result)}")
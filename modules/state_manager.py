@@ -1,6 +1,43 @@
+import json
 from functools import lru_cache
 
-from .redis_connection import get_redis
+from .cache import ResponseCache
+from .redis_connection import (
+    get_redis,
+    get_sync_redis,
+    RedisConnection,
+    SyncRedisConnection,
+)
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+# States are stored as small redis hashes, which redis keeps in its compact
+# listpack encoding: the state under STATE_FIELD and every data item JSON
+# encoded under DATA_PREFIX + name, so merging data is a plain HSET
+STATE_FIELD = "s"
+DATA_PREFIX = "d:"
+
+
+def encode_state(state: str, data: dict = None) -> dict:
+    return {
+        STATE_FIELD: state,
+        **{DATA_PREFIX + key: json.dumps(value) for key, value in (data or {}).items()},
+    }
+
+
+def decode_state(fields: dict) -> dict | None:
+    if not fields:
+        return None
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return {
+        "state": fields.pop(STATE_FIELD, None),
+        "data": {
+            key.removeprefix(DATA_PREFIX): json.loads(value)
+            for key, value in fields.items()
+            if key.startswith(DATA_PREFIX)
+        },
+    }
 
 
 class MainBotStates:
@@ -29,33 +66,107 @@ class MainBotStates:
     # Add channel to bot state
     ADD_CHANNEL_TO_BOT = "add_channel_to_bot"
 
+    # Broadcast state
+    CHOOSE_BROADCAST_BOT = "choose_broadcast_bot"
+    ENTER_BROADCAST_MESSAGE = "enter_broadcast_message"
+
 
 class StateManager:
+    """
+    User states in redis behind a write-through in-process cache. Only the
+    worker running the main bot reads and writes states, so cached states stay
+    valid until they expire after STATE_CACHE_TTL seconds.
+
+    Users in the NOTHING state have no key, and a state expires after STATE_TTL
+    seconds without changes, so abandoned flows start over and idle users
+    don't take memory
+    """
+
+    def __init__(self):
+        self.client: RedisConnection = get_redis()
+        self.cache: ResponseCache = ResponseCache(bot_settings.STATE_CACHE_SIZE)
+        self.cache_ttl: int = (
+            min(bot_settings.STATE_CACHE_TTL, bot_settings.STATE_TTL)
+            if bot_settings.STATE_TTL
+            else bot_settings.STATE_CACHE_TTL
+        )
+
+    @staticmethod
+    def get_key(user_id: int) -> str:
+        return f"state:{user_id}"
+
+    @staticmethod
+    def write(pipe, key: str, state: str, data: dict = None, update: bool = False):
+        """Queue the commands that store a state, shared with SyncStateManager"""
+        if not update:
+            pipe.delete(key)
+            if state == MainBotStates.NOTHING and not data:
+                return
+        pipe.hset(key, mapping=encode_state(state, data))
+        if bot_settings.STATE_TTL:
+            pipe.expire(key, bot_settings.STATE_TTL)
+
+    async def set_state(
+        self, user_id: int, state: str, data: dict = None, update: bool = False
+    ):
+        """Set the state for a user, `update` merges data into the stored data."""
+        key = self.get_key(user_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            self.write(pipe, key, state, data, update)
+            if update:
+                pipe.hgetall(key)
+            results = await pipe.execute()
+        state_data = (
+            decode_state(results[-1])
+            if update
+            else {"state": state, "data": data or {}}
+        )
+        self.cache.set(key, state_data, self.cache_ttl)
+
+    async def get_state_with_data(self, user_id: int) -> dict:
+        """Get the state for a user."""
+        key = self.get_key(user_id)
+        state_data = self.cache.get(key)
+        if state_data is None:
+            state_data = decode_state(await self.client.hgetall(key)) or {
+                "state": MainBotStates.NOTHING,
+                "data": {},
+            }
+            self.cache.set(key, state_data, self.cache_ttl)
+        return state_data
+
+    def clear_cache(self):
+        """Forget cached states, e.g. when the main bot moves to this worker"""
+        self.cache = ResponseCache(bot_settings.STATE_CACHE_SIZE)
+
+    async def reset_state(self, user_id: int):
+        """Reset the state for a user."""
+        await self.set_state(user_id, MainBotStates.NOTHING)
+
+
+class SyncStateManager:
+    """
+    Blocking version of StateManager for scripts, never use it inside handlers
+    """
+
     def __init__(self):
-        self.client = get_redis()
+        self.client: SyncRedisConnection = get_sync_redis()
 
     def set_state(
         self, user_id: int, state: str, data: dict = None, update: bool = False
     ):
-        """Set the state for a user."""
-        if data is None:
-            data = {}
-        key = f"user:{user_id}:state"
-        value = {
-            "state": state,
-            "data": (
-                data
-                if not update
-                else {**self.get_state_with_data(user_id).get("data"), **data}
-            ),
-        }
-        self.client.set_as_json(key, value)
-
-    def get_state_with_data(self, user_id: int) -> dict | None:
+        """Set the state for a user, `update` merges data into the stored data."""
+        with self.client.pipeline(transaction=True) as pipe:
+            StateManager.write(
+                pipe, StateManager.get_key(user_id), state, data, update
+            )
+            pipe.execute()
+
+    def get_state_with_data(self, user_id: int) -> dict:
         """Get the state for a user."""
-        key = f"user:{user_id}:state"
-        state_data = self.client.get_as_json(key)
-        return state_data
+        return decode_state(
+            self.client.hgetall(StateManager.get_key(user_id))
+        ) or {"state": MainBotStates.NOTHING, "data": {}}
 
     def reset_state(self, user_id: int):
         """Reset the state for a user."""
@@ -63,5 +174,10 @@ class StateManager:
 
 
 @lru_cache
-def get_state_manager():
+def get_state_manager() -> StateManager:
     return StateManager()
+
+
+@lru_cache
+def get_sync_state_manager() -> SyncStateManager:
+    return SyncStateManager()
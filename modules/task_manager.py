@@ -1,40 +1,206 @@
 import asyncio
+import inspect
 import logging
+import random
+import time
+from collections import deque
 from functools import lru_cache
+from typing import Awaitable, Callable
 
 logger = logging.getLogger(__name__)
 
 
+class RestartPolicy:
+    """
+    When and how fast a task of a group is restarted. Restarts back off
+    exponentially, a task that needs more than `max_restarts` restarts within
+    `window` seconds is given up
+    """
+
+    ALWAYS: str = "always"
+    ON_FAILURE: str = "on_failure"
+    NEVER: str = "never"
+
+    def __init__(
+        self,
+        restart: str = ALWAYS,
+        backoff: float = 1.0,
+        max_backoff: float = 60.0,
+        max_restarts: int = 10,
+        window: float = 300.0,
+    ):
+        self.restart: str = restart
+        self.backoff: float = backoff
+        self.max_backoff: float = max_backoff
+        self.max_restarts: int = max_restarts
+        self.window: float = window
+
+    def __repr__(self):
+        return (
+            f"RestartPolicy(restart={self.restart}, "
+            f"max_restarts={self.max_restarts}, window={self.window})"
+        )
+
+    def should_restart(self, failed: bool) -> bool:
+        return self.restart == self.ALWAYS or (
+            self.restart == self.ON_FAILURE and failed
+        )
+
+    def get_delay(self, restarts: int) -> float:
+        """Jittered exponential backoff before the nth restart in the window"""
+        delay = min(self.backoff * 2 ** (restarts - 1), self.max_backoff)
+        return delay * random.uniform(0.5, 1.5)
+
+
+class TaskHealth:
+    """
+    State of a supervised task
+    """
+
+    STARTING: str = "starting"
+    RUNNING: str = "running"
+    BACKOFF: str = "backoff"
+    FINISHED: str = "finished"
+    FAILED: str = "failed"
+    CANCELLED: str = "cancelled"
+
+    def __init__(self):
+        self.status: str = self.STARTING
+        self.restarts: int = 0
+        self.last_error: str | None = None
+        self.started_at: float | None = None
+
+    def __repr__(self):
+        return f"TaskHealth(status={self.status}, restarts={self.restarts})"
+
+    def to_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+            "started_at": self.started_at,
+        }
+
+
 class TaskManager:
     """
-    Manager class that manages all tasks in the main loop
+    Supervisor of all tasks in the main loop.
+
+    A task is added as a coroutine factory, e.g. `bot.start`, so it can be
+    restarted with a fresh coroutine when it crashes or returns, following the
+    restart policy of its group. Tasks run inside one TaskGroup while
+    `run_all_tasks_in_main_loop` runs, tasks added later included
     """
 
     # Task groups
     BOTS: str = "BOTS"
     RATE_LIMITER: str = "RL"
+    BROADCASTS: str = "BC"
+    SERVICES: str = "SV"
+
+    POLICIES: dict[str, RestartPolicy] = {
+        # A bot that crashed or was disconnected reconnects within seconds
+        BOTS: RestartPolicy(RestartPolicy.ALWAYS, backoff=1, max_restarts=20),
+        RATE_LIMITER: RestartPolicy(RestartPolicy.ALWAYS, backoff=0.5),
+        # A finished broadcast is done, a crashed one resumes from its checkpoint
+        BROADCASTS: RestartPolicy(
+            RestartPolicy.ON_FAILURE, backoff=5, max_restarts=5
+        ),
+        SERVICES: RestartPolicy(RestartPolicy.ALWAYS, backoff=1),
+    }
 
     def __init__(self):
         self.tasks: dict = {
             self.RATE_LIMITER: {},
             self.BOTS: {},
+            self.BROADCASTS: {},
+            self.SERVICES: {},
+        }
+        self.health: dict[str, dict[str, TaskHealth]] = {
+            task_group: {} for task_group in self.tasks
         }
+        self.group: asyncio.TaskGroup | None = None
+        self.stopping: asyncio.Event = asyncio.Event()
 
-    async def run_task(self, task_id: str, task_group: str, task):
+    async def run_task(
+        self,
+        task_id: str,
+        task_group: str,
+        task_factory: Callable[[], Awaitable] | Awaitable,
+    ):
+        """Run the task and restart it according to the group's policy"""
+        policy = self.POLICIES[task_group]
+        health = self.health[task_group][task_id] = TaskHealth()
+        # A coroutine object can be awaited only once
+        restartable = callable(task_factory)
+        restarts = deque()
         try:
-            logger.info(f"Running task {task}")
-            await task
+            while True:
+                health.status = TaskHealth.RUNNING
+                health.started_at = time.time()
+                try:
+                    logger.info(f"Running task {task_id}")
+                    await (task_factory() if restartable else task_factory)
+                    failed = False
+                except Exception as e:
+                    health.last_error = f"{type(e).__name__}: {str(e)}"
+                    logger.error(f"Task {task_id} crashed: {health.last_error}")
+                    failed = True
+
+                if not restartable or not policy.should_restart(failed):
+                    health.status = (
+                        TaskHealth.FAILED if failed else TaskHealth.FINISHED
+                    )
+                    return
+
+                now = time.monotonic()
+                restarts.append(now)
+                while restarts[0] < now - policy.window:
+                    restarts.popleft()
+                if len(restarts) > policy.max_restarts:
+                    logger.error(
+                        f"Task {task_id} restarted {policy.max_restarts} times "
+                        f"in {policy.window}s, giving up"
+                    )
+                    health.status = TaskHealth.FAILED
+                    return
+
+                delay = policy.get_delay(len(restarts))
+                logger.warning(f"Restarting task {task_id} in {delay:.1f}s")
+                health.status = TaskHealth.BACKOFF
+                health.restarts += 1
+                await asyncio.sleep(delay)
         except asyncio.CancelledError:
+            health.status = TaskHealth.CANCELLED
             logger.info(f"Task {task_id} has been cancelled.")
         finally:
-            self.tasks.get(task_group).pop(task_id)
+            tasks = self.tasks.get(task_group)
+            if tasks.get(task_id) is asyncio.current_task():
+                tasks.pop(task_id)
+            # Only tasks that gave up keep their health, for monitoring
+            if health.status != TaskHealth.FAILED:
+                self.health[task_group].pop(task_id, None)
             logger.info(f"Task {task_id} has been completed.")
 
-    def add_task(self, task_id: str, task_group: str, task_obj):
+    def add_task(
+        self,
+        task_id: str,
+        task_group: str,
+        task_factory: Callable[[], Awaitable] | Awaitable,
+    ):
+        """
+        Add a task, `task_factory` returns a new coroutine for every (re)start.
+        A coroutine object is accepted too but is never restarted
+        """
         if task_id in self.tasks.get(task_group).keys():
+            if inspect.iscoroutine(task_factory):
+                task_factory.close()
             return False
-        loop = asyncio.get_running_loop()
-        task = loop.create_task(self.run_task(task_id, task_group, task_obj), name=task_id)
+        coroutine = self.run_task(task_id, task_group, task_factory)
+        if self.group is not None:
+            task = self.group.create_task(coroutine, name=task_id)
+        else:
+            task = asyncio.get_running_loop().create_task(coroutine, name=task_id)
         self.tasks.get(task_group)[task_id] = task
         return True
 
@@ -47,18 +213,59 @@ class TaskManager:
         else:
             return False
 
+    async def stop_task(self, task_id: str, task_group: str):
+        """Cancel a task and wait until it has finished"""
+        task = self.tasks.get(task_group).get(task_id)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return True
+
+    async def stop_task_group(self, task_group: str):
+        """Cancel all tasks of a group and wait until they have finished"""
+        tasks = list(self.tasks.get(task_group).values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
     async def run_tasks_in_task_group(self, task_group: str):
         await asyncio.gather(
             *self.tasks.get(task_group).values(), return_exceptions=True
         )
 
     async def run_all_tasks_in_main_loop(self):
-        all_tasks = []
-        for value in self.tasks.values():
-            for task in value.values():
-                all_tasks.append(task)
-        await asyncio.gather(
-            *all_tasks, return_exceptions=True
+        """
+        Supervise all tasks, including the ones added later, until `stop` is
+        called, then cancel the remaining tasks and wait for them
+        """
+        self.stopping.clear()
+        async with asyncio.TaskGroup() as group:
+            self.group = group
+            try:
+                await self.stopping.wait()
+            finally:
+                self.group = None
+                for task_group in self.tasks:
+                    await self.stop_task_group(task_group)
+
+    def stop(self):
+        self.stopping.set()
+
+    def get_health(self) -> dict[str, dict[str, dict]]:
+        """Health of every task that runs or has given up, per group"""
+        return {
+            task_group: {
+                task_id: health.to_dict() for task_id, health in tasks.items()
+            }
+            for task_group, tasks in self.health.items()
+        }
+
+    def count(self, task_group: str, status: str = None) -> int:
+        if status is None:
+            return len(self.tasks.get(task_group))
+        return sum(
+            health.status == status for health in self.health[task_group].values()
         )
 
 
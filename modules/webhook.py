@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable
+
+from aiohttp import web
+from telethon.errors import FloodWaitError, UserIsBlockedError
+
+from .backend import get_backend_client, BackendClient
+from .settings import get_settings, Settings
+
+bot_settings: Settings = get_settings()
+
+logger = logging.getLogger(__name__)
+
+# Telethon parse modes and their Bot API names
+PARSE_MODES = {"html": "HTML", "md": "Markdown", "markdown": "Markdown"}
+
+
+class BotApiError(Exception):
+    """The Bot API rejected a request"""
+
+    def __init__(self, method: str, code: int | None, description: str | None):
+        super().__init__(f"{method} failed with {code}: {description}")
+        self.code: int | None = code
+
+
+class BotApi:
+    """
+    Bot API calls of one bot over the shared backend session. Errors the rate
+    limiter and broadcasts handle are raised as the matching Telethon errors
+    """
+
+    def __init__(self, token: str):
+        self.url: str = f"{bot_settings.TELEGRAM_API_URL}/bot{token}/"
+        self.backend: BackendClient = get_backend_client()
+
+    async def call(self, method: str, **params):
+        response, status_code = await self.backend.request(
+            "POST", self.url + method, data=params
+        )
+        if response.get("ok"):
+            return response.get("result")
+        if status_code == 429:
+            raise FloodWaitError(
+                None, capture=response.get("parameters", {}).get("retry_after", 1)
+            )
+        if status_code == 403:
+            raise UserIsBlockedError(None)
+        raise BotApiError(method, status_code, response.get("description"))
+
+    async def set_webhook(self, url: str, secret_token: str):
+        return await self.call(
+            "setWebhook",
+            url=url,
+            secret_token=secret_token,
+            allowed_updates=["message"],
+        )
+
+    async def delete_webhook(self):
+        """Remove the webhook, pending updates stay for getUpdates"""
+        return await self.call("deleteWebhook", drop_pending_updates=False)
+
+    async def send_message(self, chat_id: int, message: str, parse_mode: str = None):
+        params = {"chat_id": chat_id, "text": message}
+        if parse_mode:
+            params["parse_mode"] = PARSE_MODES.get(parse_mode.lower(), parse_mode)
+        return await self.call("sendMessage", **params)
+
+
+class WebhookEvent:
+    """
+    A Bot API message update with the parts of Telethon's NewMessage event the
+    bot handlers use
+    """
+
+    def __init__(self, bot, message: dict):
+        self.bot = bot
+        self.message: dict = message
+        self.chat_id: int = message["chat"]["id"]
+        self.sender_id: int | None = message.get("from", {}).get("id")
+        self.raw_text: str = message.get("text", "")
+        self.pattern_match: re.Match | None = None
+
+    def __repr__(self):
+        return f"WebhookEvent(bot_id={self.bot.bot_id}, chat_id={self.chat_id})"
+
+    async def respond(self, message: str, parse_mode: str = None):
+        return await self.bot.api.send_message(
+            self.chat_id, message, parse_mode=parse_mode
+        )
+
+
+class WebhookServer:
+    """
+    One HTTP listener that receives Bot API updates for every webhook bot of
+    the worker. Telegram gets its answer at once and the update is handled in
+    the background, so a slow handler doesn't hold back other updates
+    """
+
+    PATH: str = "/webhook/{bot_id}"
+    SECRET_HEADER: str = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, on_update: Callable[[str, dict], Awaitable]):
+        self.on_update: Callable[[str, dict], Awaitable] = on_update
+        self.tasks: set[asyncio.Task] = set()
+        # Cleared on shutdown, Telegram retries refused updates later
+        self.accepting: bool = True
+        self.app: web.Application = web.Application()
+        self.app.router.add_post(self.PATH, self.handle)
+
+    def __repr__(self):
+        return f"WebhookServer(handling={len(self.tasks)})"
+
+    @classmethod
+    def get_url(cls, bot_id) -> str:
+        return bot_settings.WEBHOOK_URL.rstrip("/") + cls.PATH.format(bot_id=bot_id)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if request.headers.get(self.SECRET_HEADER) != bot_settings.WEBHOOK_SECRET:
+            return web.Response(status=403)
+        if not self.accepting:
+            return web.Response(status=503)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        task = asyncio.create_task(
+            self.process(request.match_info["bot_id"], update)
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def drain(self, timeout: float):
+        """Stop accepting updates and wait for the ones being handled"""
+        self.accepting = False
+        if self.tasks:
+            await asyncio.wait(list(self.tasks), timeout=timeout)
+
+    async def process(self, bot_id: str, update: dict):
+        try:
+            await self.on_update(bot_id, update)
+        except Exception as e:
+            logger.error(f"Error handling update of bot {bot_id}: {str(e)}")
+
+    async def run(self):
+        """Serve until cancelled, workers on one host share the port"""
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(
+            runner,
+            bot_settings.WEBHOOK_HOST,
+            bot_settings.WEBHOOK_PORT,
+            reuse_port=True,
+        )
+        await site.start()
+        logger.info(
+            f"Webhook server listening on "
+            f"{bot_settings.WEBHOOK_HOST}:{bot_settings.WEBHOOK_PORT}"
+        )
+        try:
+            await asyncio.Future()
+        finally:
+            await runner.cleanup()
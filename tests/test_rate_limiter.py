@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+from modules import handlers
+from modules.rate_limiter import get_rate_limiter_from_memory, RateLimiter
+from modules.settings import get_settings
+from modules.task_manager import get_task_manager, TaskManager
+
+bot_settings = get_settings()
+task_manager = get_task_manager()
+
+
+class FakeChat:
+    id = 1
+
+
+class FakeEvent:
+    chat = FakeChat()
+    chat_id = FakeChat.id
+
+    def __init__(self):
+        self.replies = []
+
+    async def respond(self, message, **kwargs):
+        self.replies.append(message)
+
+
+class FakeBackend:
+    async def fetch_data(self, url, params=None, **kwargs):
+        return [], 200
+
+
+def test_main_bot_handler_reply_is_sent():
+    async def main():
+        # The limiter is started the way MainBot.run_bot starts it
+        rate_limiter = get_rate_limiter_from_memory(
+            bot_id=bot_settings.MAIN_BOT_ID, bot_username=bot_settings.MAIN_BOT_USERNAME
+        )
+        rate_limiter.start()
+        event = FakeEvent()
+        try:
+            await asyncio.wait_for(
+                handlers.fetch_bots_handler(event, FakeBackend()), timeout=2
+            )
+        finally:
+            await task_manager.stop_task(rate_limiter.bot_id, TaskManager.RATE_LIMITER)
+        assert handlers.rate_limiter is rate_limiter
+        assert event.replies == ["Sizda botlar yo'q"]
+
+    asyncio.run(main())
+
+
+def test_bucket_refills_after_a_pause():
+    rate_limiter = RateLimiter("1", "bot")
+    # The bucket was last refilled a while ago
+    rate_limiter.bucket.updated_at -= 10
+    rate_limiter.bucket.pause(0.05)
+    time.sleep(0.1)
+
+    sent = 0
+    while rate_limiter.bucket.try_acquire() == 0:
+        sent += 1
+    assert sent < 3
+
+
+def test_flood_wait_lowers_the_rate_once_per_pause():
+    rate_limiter = RateLimiter("1", "bot")
+    for _ in range(rate_limiter.WORKERS):
+        rate_limiter.on_flood_wait(5)
+
+    assert rate_limiter.bucket.rate == rate_limiter.max_rate / 2
+    assert rate_limiter.bucket.capacity == rate_limiter.LIMIT // 2
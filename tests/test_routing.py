@@ -0,0 +1,62 @@
+import pytest
+
+from modules.routing import Router
+
+
+async def first(event):
+    pass
+
+
+async def second(event):
+    pass
+
+
+async def third(event):
+    pass
+
+
+@pytest.mark.parametrize(
+    "pattern, text",
+    [
+        # Group name of an earlier route
+        (r"(?P<n>b)", "b"),
+        # Global flags after another route
+        (r"(?i)hello", "HELLO"),
+        # Backreference, the wrapping group shifts the group numbers
+        (r"(a)\1", "aa"),
+    ],
+)
+def test_patterns_that_cant_be_combined(pattern, text):
+    router = Router([(r"(?P<n>x)", first), (pattern, second), ("c+", third)])
+
+    assert len(router) == 3
+    handler, match = router.resolve(text)
+    assert handler is second
+    assert match.group(0) == text
+    assert router.resolve("x")[0] is first
+    assert router.resolve("ccc")[0] is third
+    assert router.resolve("z") is None
+
+
+def test_first_matching_route_wins_across_regexes():
+    router = Router([("b.*", first), (r"(?i)ab", second), ("a.*", third)])
+
+    assert router.resolve("bq")[0] is first
+    assert router.resolve("abz")[0] is second
+    assert router.resolve("AB")[0] is second
+    assert router.resolve("az")[0] is third
+
+
+def test_invalid_pattern_is_skipped():
+    router = Router([("(", first), ("a", second)])
+
+    assert len(router) == 1
+    assert router.resolve("a") == (second, None)
+
+
+def test_regex_route_wins_over_a_later_literal_route():
+    router = Router([(r"/st\w+", first), ("/start", second), ("token", third)])
+
+    assert router.resolve("/start")[0] is first
+    assert router.resolve("/stop")[0] is first
+    assert router.resolve("token") == (third, None)